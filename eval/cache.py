@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+
+# Startup time with and without the parse cache.
+#
+#   ./eval/cache.py [test] [exe [args...]]
+#
+# eg. `./eval/cache.py ./nfs` or `./eval/cache.py python2 -m nefarious`.
+# Times `--parse` on each benchmark with an empty cache (cold), then again once
+# the cache has been filled (warm).
+# Prints CSV: benchmark, cold seconds, warm seconds, speedup.
+
+import os
+import shutil
+import sys
+import tempfile
+
+from parse import arguments, mean, time_parse
+
+
+BENCHMARKS = [
+    'bench/fib-m',
+    'bench/nbody',
+    'bench/binary.nfs',
+    'bench/nqueens.nfs',
+    'bench/spectral-norm.nfs',
+]
+
+
+def please(exe, path, samples):
+    cold = []
+    warm = []
+    for i in range(samples):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cached = exe + ['--cache', cache_dir]
+            cold.append(time_parse(cached, path))
+            warm.append(time_parse(cached, path))
+        finally:
+            shutil.rmtree(cache_dir)
+    cold, warm = mean(cold), mean(warm)
+    print(",".join((os.path.basename(path), "%.3f" % cold, "%.3f" % warm, "%.1f" % (cold / warm))))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    TEST, exe = arguments(['./nfs'])
+
+    for path in BENCHMARKS:
+        please(exe, path, 1 if TEST else 3)
@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+
+# Parse time with and without the JIT.
+#
+#   ./eval/jit.py [test] [nfs nfsj]
+#
+# Times `--parse` on the generated programs from parse.py, first with the plain
+# build (default ./nfs) and then with the JIT build (default ./nfsj).
+# Prints CSV: benchmark, size, nfs seconds, nfsj seconds, speedup.
+
+import os
+import sys
+import tempfile
+
+from parse import arguments, benchmarks, test_benchmarks, time_parse, mean
+
+
+def please(nfs, nfsj, name, generate, size, samples):
+    with tempfile.NamedTemporaryFile('w', suffix='.nfs', delete=False) as f:
+        f.write(generate(size))
+    try:
+        plain = mean([time_parse([nfs], f.name) for i in range(samples)])
+        jit = mean([time_parse([nfsj], f.name) for i in range(samples)])
+    finally:
+        os.unlink(f.name)
+    print(",".join((name, str(size), "%.3f" % plain, "%.3f" % jit, "%.1f" % (plain / jit))))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    TEST, (nfs, nfsj) = arguments(['./nfs', './nfsj'])
+
+    for name, generate, sizes in (test_benchmarks if TEST else benchmarks):
+        for size in sizes:
+            please(nfs, nfsj, name, generate, size, 1 if TEST else 3)
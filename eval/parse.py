@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+# Parse-time benchmarks, on generated programs.
+#
+#   ./eval/parse.py [test] [exe [args...]]
+#
+# eg. `./eval/parse.py ./nfs` or `./eval/parse.py python2 -m nefarious`.
+# Prints CSV: benchmark, size, seconds, microseconds per unit of size.
+# If the parser is linear, the last column should stay (roughly) flat.
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+
+def lines(n):
+    return "INT_ADD 1 2\n" * n
+
+def list_literal(n):
+    return "[" + " ".join(str(i) for i in range(n)) + "]\n"
+
+def empty_lists(n):
+    # each `[]` is a run of nullable slots: SEP, then SEP Repeat SEP
+    return "[" + " ".join(["[]"] * n) + "]\n"
+
+def right_recursion(n):
+    return "define w Int:x { x }\ndefine w { 0 }\n" + " ".join(["w"] * n) + "\n"
+
+benchmarks = [
+    ('lines', lines, [1000, 2000, 5000, 10000, 20000]),
+    ('list', list_literal, [10000, 20000, 50000, 100000]),
+    # deeper, and printing the tree overflows the stack
+    ('right', right_recursion, [250, 500, 1000, 2000]),
+    ('empty', empty_lists, [1000, 2000, 5000, 10000]),
+]
+test_benchmarks = [
+    ('lines', lines, [500, 1000, 2000]),
+    ('list', list_literal, [100, 200, 300]),
+    ('right', right_recursion, [100, 200, 300]),
+    ('empty', empty_lists, [100, 200, 300]),
+]
+
+
+def child_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run(command):
+    """Run command, and return (seconds, stdout); raise if it fails."""
+    before = child_time()
+    p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = child_time() - before
+    if b'Unexpected' in p.stdout or p.returncode != 0:
+        raise RuntimeError(p.stdout.decode('utf-8')[-500:] + p.stderr.decode('utf-8')[-500:])
+    return elapsed, p.stdout
+
+def time_parse(exe, path):
+    elapsed, output = run(exe + ['--parse', path])
+    return elapsed
+
+def mean(numbers):
+    return float(sum(numbers)) / max(len(numbers), 1)
+
+def please(exe, name, generate, size, samples):
+    with tempfile.NamedTemporaryFile('w', suffix='.nfs', delete=False) as f:
+        f.write(generate(size))
+    try:
+        average = mean([time_parse(exe, f.name) for i in range(samples)])
+    finally:
+        os.unlink(f.name)
+    print(",".join((name, str(size), "%.3f" % average, "%.1f" % (average / size * 1e6))))
+    sys.stdout.flush()
+
+
+def arguments(default):
+    """`[test] [args...]` from the command line, as (TEST, args)."""
+    args = sys.argv[1:]
+    test = bool(args) and args[0] == 'test'
+    if test:
+        args.pop(0)
+    return test, args or default
+
+
+if __name__ == '__main__':
+    TEST, exe = arguments(['./nfs'])
+
+    for name, generate, sizes in (test_benchmarks if TEST else benchmarks):
+        for size in sizes:
+            please(exe, name, generate, size, 1 if TEST else 3)
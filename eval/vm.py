@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+# Run time on the tree interpreter and on the bytecode VM.
+#
+#   ./eval/vm.py [test] [exe [args...]]
+#
+# eg. `./eval/vm.py ./nfsj` or `./eval/vm.py python2 -m nefarious`.
+# Runs each benchmark as usual, then again with `--vm`, and checks they print
+# the same thing.
+# Prints CSV: benchmark, tree seconds, vm seconds, speedup.
+
+import os
+import sys
+
+from parse import arguments, mean, run
+
+
+BENCHMARKS = [
+    'bench/fib-m',
+    'bench/fib-f',
+    'bench/nbody',
+    'bench/records',
+    'bench/binary.nfs',
+    'bench/nqueens.nfs',
+    'bench/spectral-norm.nfs',
+]
+
+
+def please(exe, path, samples):
+    tree = []
+    vm = []
+    for i in range(samples):
+        elapsed, expected = run(exe + [path])
+        tree.append(elapsed)
+        elapsed, output = run(exe + ['--vm', path])
+        vm.append(elapsed)
+        if output != expected:
+            raise RuntimeError(path + ": --vm printed something different")
+    tree, vm = mean(tree), mean(vm)
+    print(",".join((os.path.basename(path), "%.3f" % tree, "%.3f" % vm, "%.1f" % (tree / vm))))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    TEST, exe = arguments(['./nfs'])
+
+    for path in BENCHMARKS:
+        please(exe, path, 1 if TEST else 3)
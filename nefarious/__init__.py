@@ -1,31 +1,78 @@
-
 import os
 import sys
 sys.path.append('./pypy/')
 
-from .grammar import parse, parse_and_run
+from .grammar import ParseSession, show_tree, run_tree
+from .parser import counters
+from .types import Error
+from . import cache
+from . import image
+from .source import load as load_source
+
+
+
+def run(fp, parse_only, inlining, use_vm, cache_dir, image_file, save_image):
+    source = load_source(fp)
+
+    session = ParseSession()
+    mark = session.highest_priority
+    base = cache.grammar_fingerprint(session) if save_image else ""
+
+    try:
+        preamble = None
+        names = None
+        if image_file:
+            try:
+                preamble = image.load(image_file, session)
+            except cache.CacheError as e:
+                os.write(2, e.message + "\n")
+                return 1
+            names = preamble.names
+
+        tree = None
+        key = ""
+        if cache_dir:
+            fingerprint = cache.grammar_fingerprint(session)
+            if preamble is not None:
+                # the tree can refer to the image's Names
+                fingerprint = cache.md5(fingerprint + preamble.digest)
+            key = cache.key(source, fingerprint)
+            tree = cache.load(cache_dir, key, names)
+        if tree is None:
+            tree = session.parse(source)
+            if cache_dir and not isinstance(tree, Error):
+                cache.save(cache_dir, key, tree, names)
+    finally:
+        source.close() # tokens are copied out of it
 
+    if preamble is not None and not isinstance(tree, Error):
+        tree = preamble.prepend(tree)
 
+    if save_image and not isinstance(tree, Error):
+        try:
+            image.save(save_image, base, tree, image.new_rules(session, mark))
+        except cache.CacheError as e:
+            os.write(2, e.message + "\n")
+            return 1
+        return 0
 
-def run(fp, parse_only, inlining):
-    source = ""
-    while True:
-        read = os.read(fp, 4096)
-        if len(read) == 0:
-            break
-        source += read
-    os.close(fp)
     if parse_only:
-        msg = parse(source)
+        msg = show_tree(tree)
     else:
-        msg = parse_and_run(source, inlining=inlining)
+        msg = run_tree(tree, inlining, use_vm)
     os.write(1, msg)
     os.write(1, '\n')
     #mainloop(program)
+    return 0
 
 def entry_point(argv):
     parse_only = False
     inlining = True
+    use_vm = False
+    cache_dir = None
+    image_file = None
+    save_image = None
+    stats = False
     try:
         while True:
             if argv[1] == '--parse':
@@ -34,6 +81,21 @@ def entry_point(argv):
             elif argv[1] == '--noinline':
                 argv.pop(1)
                 inlining = False
+            elif argv[1] == '--vm':
+                argv.pop(1)
+                use_vm = True
+            elif argv[1] == '--cache':
+                argv.pop(1)
+                cache_dir = argv.pop(1)
+            elif argv[1] == '--image':
+                argv.pop(1)
+                image_file = argv.pop(1)
+            elif argv[1] == '--save-image':
+                argv.pop(1)
+                save_image = argv.pop(1)
+            elif argv[1] == '--stats':
+                argv.pop(1)
+                stats = True
             else:
                 break
         filename = argv[1]
@@ -45,9 +107,10 @@ def entry_point(argv):
         fp = 0
     else:
         fp = os.open(filename, os.O_RDONLY, 0777)
-    run(fp, parse_only, inlining)
-    return 0
+    status = run(fp, parse_only, inlining, use_vm, cache_dir, image_file, save_image)
+    if stats:
+        os.write(2, counters.show())
+    return status
 
 def target(*args):
     return entry_point, None
-
@@ -1,5 +1,7 @@
 from .tree import *
 
+from rpython.rlib.rarithmetic import ovfcheck
+
 def get_while_location(block, cond, self):
     #assert isinstance(self, Node)
     return self.sexpr()
@@ -25,6 +27,9 @@ class Builtin(Node):
     def _args(self):
         raise NotImplementedError
 
+    # Subclasses of Unary/Infix/TernaryBuiltin implement `operate()` on their
+    # evaluated arguments, so the VM can call it too.
+
     @classmethod
     def _test_cases(cls):
         values = {
@@ -58,6 +63,11 @@ class UnaryBuiltin(Builtin):
         self.child.set_parent(self)
     def _args(self):
         return [self.child]
+    def evaluate(self, frame):
+        jit.promote(self.child)
+        return self.operate(self.child.evaluate(frame))
+    def operate(self, value):
+        raise NotImplementedError
     def replace_child(self, child, other):
         if child is self.child:
             self.child = other
@@ -75,6 +85,14 @@ class InfixBuiltin(Builtin):
         self.right.set_parent(self)
     def _args(self):
         return [self.left, self.right]
+    def evaluate(self, frame):
+        jit.promote(self.left)
+        jit.promote(self.right)
+        left = self.left.evaluate(frame)
+        right = self.right.evaluate(frame) # left may have replaced it
+        return self.operate(left, right)
+    def operate(self, left, right):
+        raise NotImplementedError
     def replace_child(self, child, other):
         if child is self.left:
             self.left = other
@@ -95,6 +113,13 @@ class TernaryBuiltin(Builtin):
         self.three.set_parent(self)
     def _args(self):
         return [self.one, self.two, self.three]
+    def evaluate(self, frame):
+        one = self.one.evaluate(frame)
+        two = self.two.evaluate(frame)
+        three = self.three.evaluate(frame)
+        return self.operate(one, two, three)
+    def operate(self, one, two, three):
+        raise NotImplementedError
     def replace_child(self, child, other):
         if child is self.one:
             self.one = other
@@ -110,18 +135,14 @@ class TernaryBuiltin(Builtin):
 class PRINT(UnaryBuiltin):
     type = Internal.get('Line')
     arg_types = [Type.ANY]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        value = self.child.evaluate(frame)
+    def operate(self, value):
         assert isinstance(value, Value) # might make compilation faster?
         print(value.sexpr()) # PRINT
 
 class REPR(UnaryBuiltin):
     type = Type.get('Text')
     arg_types = [Type.ANY]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        value = self.child.evaluate(frame)
+    def operate(self, value):
         return W_Text.fromstr(value.sexpr()) # REPR
 
 
@@ -130,9 +151,7 @@ Bool = Type.get('Bool')
 class BOOL_NOT(UnaryBuiltin):
     type = Bool
     arg_types = [Bool]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        child = self.child.evaluate(frame)
+    def operate(self, child):
         assert isinstance(child, W_Bool)
         return W_Bool.get(not child.prim)
 
@@ -171,10 +190,7 @@ class BOOL_AND(InfixBuiltin):
 class IS_NIL(UnaryBuiltin):
     type = Bool
     arg_types = [Type.ANY]
-    def evaluate(self, frame):
-        child = self.child
-        jit.promote(child)
-        value = child.evaluate(frame)
+    def operate(self, value):
         return W_Bool.get(value == Value.NULL)
 
 
@@ -183,62 +199,61 @@ Int = Type.get('Int')
 class INT_ADD(InfixBuiltin):
     type = Int
     arg_types = [Int, Int]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Int)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Int)
-        return W_Int(left.prim.add(right.prim))
+        if isinstance(left, W_SmallInt) and isinstance(right, W_SmallInt):
+            try:
+                return W_Int.fromint(ovfcheck(left.prim + right.prim))
+            except OverflowError:
+                pass
+        return W_Int.frombigint(left.bigint().add(right.bigint()))
 
 class INT_SUB(InfixBuiltin):
     type = Int
     arg_types = [Int, Int]
-    def evaluate(self, frame): # this is expensive
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right): # this is expensive
         assert isinstance(left, W_Int)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Int)
-        return W_Int(left.prim.sub(right.prim))
+        if isinstance(left, W_SmallInt) and isinstance(right, W_SmallInt):
+            try:
+                return W_Int.fromint(ovfcheck(left.prim - right.prim))
+            except OverflowError:
+                pass
+        return W_Int.frombigint(left.bigint().sub(right.bigint()))
 
 class INT_MUL(InfixBuiltin):
     type = Int
     arg_types = [Int, Int]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Int)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Int)
-        return W_Int(left.prim.mul(right.prim))
+        if isinstance(left, W_SmallInt) and isinstance(right, W_SmallInt):
+            try:
+                return W_Int.fromint(ovfcheck(left.prim * right.prim))
+            except OverflowError:
+                pass
+        return W_Int.frombigint(left.bigint().mul(right.bigint()))
 
 class INT_EQ(InfixBuiltin):
     type = Bool
     arg_types = [Int, Int]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Int)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Int)
-        return W_Bool.get(left.prim.eq(right.prim))
+        if isinstance(left, W_SmallInt) and isinstance(right, W_SmallInt):
+            return W_Bool.get(left.prim == right.prim)
+        return W_Bool.get(left.bigint().eq(right.bigint()))
 
 class INT_LT(InfixBuiltin):
     type = Bool
     arg_types = [Int, Int]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Int)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Int)
-        return W_Bool.get(left.prim.lt(right.prim))
+        if isinstance(left, W_SmallInt) and isinstance(right, W_SmallInt):
+            return W_Bool.get(left.prim < right.prim)
+        return W_Bool.get(left.bigint().lt(right.bigint()))
 
 class INT_RANDOM(InfixBuiltin):
     type = Int
@@ -246,16 +261,12 @@ class INT_RANDOM(InfixBuiltin):
 
     random = Random(seed=int(time.time()))
 
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Int)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Int)
         # TODO random for bigints.
-        start = left.prim.toint()
-        end = right.prim.toint()
+        start = left.toint()
+        end = right.toint()
         f = INT_RANDOM.random.random()
         value = int(0.5 + start + f * (end - start))
         return W_Int.fromint(value)
@@ -263,11 +274,9 @@ class INT_RANDOM(InfixBuiltin):
 class INT_FLOAT(UnaryBuiltin):
     type = Type.get('Float')
     arg_types = [Int]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        child = self.child.evaluate(frame)
+    def operate(self, child):
         assert isinstance(child, W_Int)
-        return W_Float(child.prim.tofloat())
+        return W_Float(child.tofloat())
 
 
 
@@ -276,48 +285,32 @@ Float = Type.get('Float')
 class FLOAT_ADD(InfixBuiltin):
     type = Float
     arg_types = [Float, Float]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Float)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Float)
         return W_Float(left.prim + right.prim)
 
 class FLOAT_SUB(InfixBuiltin):
     type = Float
     arg_types = [Float, Float]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Float)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Float)
         return W_Float(left.prim - right.prim)
 
 class FLOAT_MUL(InfixBuiltin):
     type = Float
     arg_types = [Float, Float]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Float)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Float)
         return W_Float(left.prim * right.prim)
 
 class FLOAT_DIV(InfixBuiltin):
     type = Float
     arg_types = [Float, Float]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Float)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Float)
         return W_Float(left.prim / right.prim)
 
@@ -325,33 +318,23 @@ class FLOAT_DIV(InfixBuiltin):
 class FLOAT_LT(InfixBuiltin):
     type = Bool
     arg_types = [Float, Float]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Float)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Float)
         return W_Bool.get(left.prim < right.prim)
 
 class FLOAT_ROUND(UnaryBuiltin):
     type = Int
     arg_types = [Float]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        f = self.child.evaluate(frame)
+    def operate(self, f):
         assert isinstance(f, W_Float)
         return W_Int.fromfloat(f.prim + 0.5)
 
 class FLOAT_POW(InfixBuiltin):
     type = Float
     arg_types = [Float, Float]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Float)
-        right = self.right.evaluate(frame)
         assert isinstance(right, W_Float)
         return W_Float(math.pow(left.prim, right.prim))
 
@@ -364,39 +347,27 @@ Text = Type.get('Text')
 class TEXT_JOIN(UnaryBuiltin):
     type = Text
     arg_types = [List.get(Text)]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        text_list = self.child.evaluate(frame)
+    def operate(self, text_list):
         return W_Text.join(text_list)
 
 class TEXT_SPLIT(UnaryBuiltin):
     type = List.get(Text)
     arg_types = [Text]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        text = self.child.evaluate(frame)
+    def operate(self, text):
         assert isinstance(text, W_Text)
         return text.split()
 
 class TEXT_JOIN_WITH(InfixBuiltin):
     type = Text
     arg_types = [List.get(Text), Text]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
-        right = self.right.evaluate(frame)
+    def operate(self, left, right):
         return W_Text.join_with(left, right)
 
 class TEXT_SPLIT_BY(InfixBuiltin):
     type = List.get(Text)
     arg_types = [Text, Text]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        left = self.left.evaluate(frame)
+    def operate(self, left, right):
         assert isinstance(left, W_Text)
-        right = self.right.evaluate(frame)
         return left.split_by(right)
 
 
@@ -549,11 +520,7 @@ _List = List.get(_a)
 class LIST_ADD(InfixBuiltin):
     type = _Line
     arg_types = [_List.get(_a), _a]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        list_ = self.left.evaluate(frame)
-        item = self.right.evaluate(frame)
+    def operate(self, list_, item):
         assert isinstance(list_, W_List)
         list_.items().append(item)
 
@@ -565,14 +532,10 @@ class LIST_ADD(InfixBuiltin):
 class LIST_GET(InfixBuiltin):
     type = _a
     arg_types = [_List.get(_a), Int]
-    def evaluate(self, frame):
-        jit.promote(self.left)
-        jit.promote(self.right)
-        list_ = self.left.evaluate(frame)
+    def operate(self, list_, int_):
         assert isinstance(list_, W_List)
-        int_ = self.right.evaluate(frame)
         assert isinstance(int_, W_Int)
-        index = int_.prim.toint()
+        index = int_.toint()
         if not 1 <= index <= len(list_.items()):
             raise IndexError(index) # TODO error handling
         return list_.items()[index - 1]
@@ -580,9 +543,7 @@ class LIST_GET(InfixBuiltin):
 class LIST_LEN(UnaryBuiltin):
     type = Int
     arg_types = [_List.get(_a)]
-    def evaluate(self, frame):
-        jit.promote(self.child)
-        list_ = self.child.evaluate(frame)
+    def operate(self, list_):
         assert isinstance(list_, W_List)
         return W_Int.fromint(len(list_.items()))
 
@@ -593,13 +554,10 @@ class LIST_SET(TernaryBuiltin):
     def _test_cases(cls):
         return [] # TODO test LIST_SET
         #return [cls([W_List([W_Float(3.0)]), W_Int.fromint(1), W_Float(4.0)], _Line)]
-    def evaluate(self, frame):
-        list_ = self.one.evaluate(frame)
+    def operate(self, list_, int_, value):
         assert isinstance(list_, W_List)
-        int_ = self.two.evaluate(frame)
         assert isinstance(int_, W_Int)
-        value = self.three.evaluate(frame)
-        index = int_.prim.toint()
+        index = int_.toint()
         if not 1 <= index <= len(list_.items()):
             raise IndexError(index) # TODO error handling
         list_.items()[index - 1] = value
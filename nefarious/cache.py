@@ -0,0 +1,553 @@
+"""On-disk cache of parsed programs.
+
+Entries are keyed by a hash of the source, plus a fingerprint of the base
+grammar; so changing either just means a cache miss. We store the AST as it
+comes out of the parser, before compile() -- that's cheap to re-run, and it
+mutates the tree anyway.
+
+"""
+import os
+
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rmd5 import RMD5
+from rpython.rlib.rstruct.ieee import float_pack, float_unpack
+from rpython.rlib.rarithmetic import r_ulonglong, intmask
+from rpython.rlib.listsort import make_timsort_class
+
+from .lex import Word
+from .source import CHUNK, read
+from .builtins import *
+from . import builtins
+
+
+MAGIC = "NFSC"
+
+# Bump this when the format changes, or when macros change what they build.
+VERSION = 1
+
+# Ints in this range are written as zig-zag varints; the rest as strings.
+SMALL_INT = 1 << 62
+
+StringSort = make_timsort_class() # no list.sort() in RPython
+
+
+# Kinds of Word which can have a value; cf. Word.get()
+WORD_KINDS = ['RESERVED', 'PUNC', 'DIGITS', 'FLOAT', 'TEXT', 'WORD', 'ERROR', 'WS']
+
+
+class CacheError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+BUILTINS = {}
+ARITY = {}
+for name in dir(builtins):
+    cls = getattr(builtins, name)
+    if name.replace("_", "").isupper() and isinstance(cls, type):
+        if cls is not Builtin and issubclass(cls, Builtin):
+            BUILTINS[name] = cls
+            ARITY[name] = len(cls.arg_types)
+
+
+# Keys
+
+def new_md5():
+    if not we_are_translated():
+        # RMD5 takes about a second per 20KB on CPython
+        import hashlib
+        return hashlib.md5()
+    return RMD5()
+
+def md5(string):
+    digest = new_md5()
+    digest.update(string)
+    return digest.hexdigest()
+
+def _describe(tag):
+    if isinstance(tag, Word):
+        return "`" + tag.kind + " " + tag.sexpr()
+    assert isinstance(tag, Type)
+    return tag._str()
+
+def grammar_fingerprint(grammar):
+    """Hash of the rules in the base scope: the built-in grammar.
+
+    A program's definitions go in its ParseSession's own scopes, so this
+    doesn't change as it's parsed.
+
+    """
+    lines = []
+    scope = grammar.stack[0]
+    rules = []
+    for target in scope.rule_sets:
+        rules += scope.rule_sets[target]
+    for word in scope.bindings:
+        rules += scope.bindings[word]
+    for rule in rules:
+        line = _describe(rule.target) + " ->"
+        for symbol in rule.symbols:
+            line += " " + _describe(symbol)
+        lines.append(line)
+    StringSort(lines).sort() # dict order isn't stable on CPython
+    return md5("\n".join(lines))
+
+def key(source, fingerprint):
+    """The cache key for a Source, parsed with the grammar fingerprint."""
+    digest = new_md5()
+    digest.update(MAGIC + str(VERSION) + "\n" + fingerprint + "\n")
+    # in chunks, so a mapped source isn't copied all at once
+    for start in range(0, source.length, CHUNK):
+        digest.update(source.slice(start, min(start + CHUNK, source.length)))
+    return digest.hexdigest()
+
+def path(cache_dir, key):
+    return cache_dir + "/" + key + ".nfsc"
+
+
+# Files
+
+def read_file(filename):
+    fd = os.open(filename, os.O_RDONLY, 0777)
+    try:
+        return read(fd)
+    finally:
+        os.close(fd)
+
+def write_file(filename, data):
+    """Write via a temporary file, so readers never see half a file."""
+    temp = filename + ".tmp"
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+    os.rename(temp, filename)
+
+def load(cache_dir, key, names=None):
+    """Returns the cached tree, or None.
+
+    names are the Names the tree may refer to from outside, eg. those defined
+    by an image; they must be passed in the same order to save().
+
+    """
+    try:
+        data = read_file(path(cache_dir, key))
+    except OSError:
+        return None
+    try:
+        return loads(data, key, names)
+    except Exception:
+        return None # corrupt or hostile file; treat it as a miss
+
+def save(cache_dir, key, tree, names=None):
+    try:
+        data = dumps(tree, key, names)
+    except CacheError:
+        return # can't serialise this tree; never mind
+    try:
+        write_file(path(cache_dir, key), data)
+    except OSError:
+        pass
+
+
+# Serialisation
+
+def dumps(tree, key, names=None):
+    out = Writer(names)
+    out.raw(MAGIC)
+    out.uint(VERSION)
+    out.string(key)
+    out.node(tree)
+    return out.getvalue()
+
+def loads(data, key, names=None):
+    reader = Reader(data, names)
+    if reader.raw(len(MAGIC)) != MAGIC:
+        raise CacheError("bad magic")
+    if reader.uint() != VERSION:
+        raise CacheError("wrong version")
+    if reader.string() != key:
+        raise CacheError("wrong key")
+    tree = reader.node()
+    if reader.pos != len(data):
+        raise CacheError("trailing data")
+    return tree
+
+
+class Writer:
+    def __init__(self, names=None):
+        self.chunks = []
+        self.names = {} # Name -> index
+        if names is not None:
+            for name in names:
+                self.names[name] = len(self.names)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+    def raw(self, string):
+        self.chunks.append(string)
+
+    def uint(self, n):
+        assert n >= 0
+        while n >= 0x80:
+            self.chunks.append(chr((n & 0x7f) | 0x80))
+            n >>= 7
+        self.chunks.append(chr(n))
+
+    def int(self, n):
+        # zig-zag, so small negative numbers stay small
+        assert -SMALL_INT <= n < SMALL_INT
+        if n < 0:
+            self.uint(((~n) << 1) | 1)
+        else:
+            self.uint(n << 1)
+
+    def string(self, string):
+        self.uint(len(string))
+        self.chunks.append(string)
+
+    def nodes(self, nodes):
+        self.uint(len(nodes))
+        for node in nodes:
+            self.node(node)
+
+    def node(self, node):
+        if isinstance(node, Sequence):
+            self.raw("q")
+            self.nodes(node.nodes)
+        elif isinstance(node, Literal):
+            self.raw("l")
+            self.value(node.value)
+            self.type(node.type)
+        elif isinstance(node, ListLiteral):
+            self.raw("L")
+            self.nodes(node.items)
+            self.type(node.type)
+        elif isinstance(node, RecordLiteral):
+            self.raw("r")
+            self.uint(len(node.keys))
+            for symbol in node.keys:
+                self.name(symbol)
+            self.nodes(node.values)
+            self.type(node.type)
+        elif isinstance(node, Load):
+            self.raw("d")
+            self.name(node.name)
+            self.type(node.type)
+        elif isinstance(node, Let):
+            self.raw("e")
+            self.name(node.name)
+            self.node(node.value)
+        elif isinstance(node, NewCell):
+            self.raw("n")
+            self.name(node.name)
+        elif isinstance(node, LoadCell):
+            self.raw("c")
+            self.node(node.cell)
+            self.type(node.type)
+        elif isinstance(node, StoreCell):
+            self.raw("s")
+            self.node(node.cell)
+            self.node(node.value)
+        elif isinstance(node, Lambda):
+            self.raw("f")
+            arg_names = node.arg_names()
+            self.uint(len(arg_names))
+            for symbol in arg_names:
+                self.name(symbol)
+            self.node(node.body)
+        elif isinstance(node, Apply):
+            self.raw("a")
+            self.node(node.func_node)
+            self.node(node.record_node)
+            self.type(node.type)
+        elif isinstance(node, StaticCall) or isinstance(node, FuncCall) or isinstance(node, GenericCall):
+            raise CacheError("tree has been compiled")
+        elif isinstance(node, Call):
+            self.raw("C")
+            self.node(node.func_node)
+            self.nodes(node.args)
+            self.type(node.type)
+        elif isinstance(node, Return):
+            self.raw("R")
+            self.node(node.child)
+        elif isinstance(node, GetAttr):
+            self.raw("g")
+            self.name(node.symbol)
+            self.node(node.record)
+        elif isinstance(node, SetAttr):
+            self.raw("S")
+            self.name(node.symbol)
+            self.node(node.record)
+            self.node(node.value)
+        elif isinstance(node, Builtin):
+            self.raw("b")
+            self.string(node.__class__.__name__)
+            self.nodes(node._args())
+            self.type(node.type)
+        else:
+            raise CacheError("can't serialise node")
+
+    def name(self, name):
+        if isinstance(name, Symbol):
+            self.raw("y")
+            self.string(name.name)
+        elif name in self.names:
+            # Names are compared by identity, so keep them shared.
+            self.raw("o")
+            self.uint(self.names[name])
+        else:
+            self.raw("N")
+            self.string(name.name)
+            self.names[name] = len(self.names)
+
+    def value(self, value):
+        if isinstance(value, W_SmallInt) and -SMALL_INT <= value.toint() < SMALL_INT:
+            self.raw("i")
+            self.int(value.toint())
+        elif isinstance(value, W_Int):
+            self.raw("I")
+            self.string(value.bigint().str())
+        elif isinstance(value, W_Float):
+            self.raw("F")
+            bits = float_pack(value.prim, 8)
+            for i in range(8):
+                self.chunks.append(chr(intmask(bits >> (i * 8)) & 0xff))
+        elif isinstance(value, W_Text):
+            self.raw("t")
+            self.string(value.prim.flatten_unicode().encode('utf-8'))
+        elif isinstance(value, W_Bool):
+            self.raw("B")
+            self.uint(1 if value is Value.TRUE else 0)
+        elif isinstance(value, W_Null):
+            self.raw("u")
+        elif isinstance(value, W_Type):
+            self.raw("T")
+            self.type(value.prim)
+        else:
+            raise CacheError("can't serialise value")
+
+    def type(self, type_):
+        if type_ is None:
+            self.raw("0")
+        elif isinstance(type_, Seq):
+            self.raw("s")
+            self.type(type_.child)
+        elif isinstance(type_, Repeat):
+            self.raw("r")
+            self.type(type_.child)
+        elif isinstance(type_, Internal):
+            self.raw("i")
+            self.string(type_.name)
+        elif isinstance(type_, List):
+            self.raw("l")
+            self.type(type_.child)
+        elif isinstance(type_, Generic):
+            self.raw("g")
+            self.uint(type_.index)
+        elif isinstance(type_, Type):
+            self.raw("t")
+            self.string(type_.name)
+        else:
+            raise CacheError("can't serialise type")
+
+    def tag(self, tag):
+        if isinstance(tag, Word):
+            self.raw("w")
+            self.string(tag.kind)
+            self.string(tag.value)
+        else:
+            self.type(tag)
+
+
+class Reader:
+    def __init__(self, data, names=None):
+        self.data = data
+        self.pos = 0
+        self.names = [] if names is None else names[:]
+
+    def raw(self, length):
+        start = self.pos
+        end = start + length
+        if length < 0 or end > len(self.data):
+            raise CacheError("truncated")
+        self.pos = end
+        assert start >= 0
+        assert end >= 0
+        return self.data[start:end]
+
+    def byte(self):
+        if self.pos >= len(self.data):
+            raise CacheError("truncated")
+        char = self.data[self.pos]
+        self.pos += 1
+        return char
+
+    def uint(self):
+        n = 0
+        shift = 0
+        while True:
+            byte = ord(self.byte())
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+            if shift > 56: # at most 63 bits, so it's never negative
+                raise CacheError("bad int")
+
+    def int(self):
+        n = self.uint()
+        if n & 1:
+            return ~(n >> 1)
+        return n >> 1
+
+    def string(self):
+        return self.raw(self.uint())
+
+    def nodes(self):
+        return [self.node() for i in range(self.uint())]
+
+    def node(self):
+        tag = self.byte()
+        if tag == "q":
+            return Sequence(self.nodes())
+        elif tag == "l":
+            value = self.value()
+            return Literal(value, self.type())
+        elif tag == "L":
+            items = self.nodes()
+            return ListLiteral(items, self.type())
+        elif tag == "r":
+            keys = [self.name() for i in range(self.uint())]
+            values = self.nodes()
+            return RecordLiteral(keys, values, self.type())
+        elif tag == "d":
+            name = self.name()
+            return Load(name, self.type())
+        elif tag == "e":
+            name = self.name()
+            return Let(name, self.node())
+        elif tag == "n":
+            return NewCell(self.name())
+        elif tag == "c":
+            cell = self.node()
+            return LoadCell(cell, self.type())
+        elif tag == "s":
+            cell = self.node()
+            return StoreCell(cell, self.node())
+        elif tag == "f":
+            arg_names = []
+            for i in range(self.uint()):
+                symbol = self.name()
+                if not isinstance(symbol, Symbol):
+                    raise CacheError("bad argument name")
+                arg_names.append(symbol)
+            return Lambda(arg_names, self.node())
+        elif tag == "a":
+            func_node = self.node()
+            record_node = self.node()
+            return Apply(func_node, record_node, self.type())
+        elif tag == "C":
+            func_node = self.node()
+            args = self.nodes()
+            return Call(func_node, args, self.type())
+        elif tag == "R":
+            return Return(self.node())
+        elif tag == "g":
+            symbol = self.name()
+            return GetAttr(symbol, self.node())
+        elif tag == "S":
+            symbol = self.name()
+            record = self.node()
+            return SetAttr(symbol, record, self.node())
+        elif tag == "b":
+            name = self.string()
+            if name not in BUILTINS:
+                raise CacheError("unknown builtin")
+            args = self.nodes()
+            if len(args) != ARITY[name]:
+                raise CacheError("wrong number of arguments")
+            return BUILTINS[name](args, self.type())
+        raise CacheError("bad node")
+
+    def name(self):
+        tag = self.byte()
+        if tag == "y":
+            return Symbol.get(self.string())
+        elif tag == "o":
+            index = self.uint()
+            if index >= len(self.names):
+                raise CacheError("bad name")
+            return self.names[index]
+        elif tag == "N":
+            name = Name(self.string())
+            self.names.append(name)
+            return name
+        raise CacheError("bad name")
+
+    def value(self):
+        tag = self.byte()
+        if tag == "i":
+            return W_Int.fromint(self.int())
+        elif tag == "I":
+            return W_Int.fromstr(self.string())
+        elif tag == "F":
+            bits = r_ulonglong(0)
+            for i in range(8):
+                bits |= r_ulonglong(ord(self.byte())) << (i * 8)
+            return W_Float(float_unpack(bits, 8))
+        elif tag == "t":
+            return W_Text.fromstr(self.string())
+        elif tag == "B":
+            return Value.TRUE if self.uint() else Value.FALSE
+        elif tag == "u":
+            return Value.NULL
+        elif tag == "T":
+            return W_Type(self.type())
+        raise CacheError("bad value")
+
+    def type(self):
+        tag = self.byte()
+        if tag == "0":
+            return None
+        elif tag == "s":
+            return Seq.get(self.child_type())
+        elif tag == "r":
+            return Repeat.get(self.child_type())
+        elif tag == "i":
+            name = self.string()
+            if name in Type._cache and not isinstance(Type._cache[name], Internal):
+                raise CacheError("bad type")
+            return Internal.get(name)
+        elif tag == "l":
+            return List.get(self.child_type())
+        elif tag == "g":
+            return Generic.get(self.uint())
+        elif tag == "t":
+            name = self.string()
+            if name in Type._cache:
+                type_ = Type._cache[name]
+                if type_ is None or isinstance(type_, Internal):
+                    raise CacheError("bad type") # eg. bare List
+            return Type.get(name)
+        raise CacheError("bad type")
+
+    def child_type(self):
+        child = self.type()
+        if child is None:
+            raise CacheError("bad type")
+        return child
+
+    def tag(self):
+        if self.byte() == "w":
+            kind = self.string()
+            value = self.string()
+            if value and kind not in WORD_KINDS:
+                raise CacheError("bad word")
+            return Word.get(kind, value)
+        self.pos -= 1
+        return self.type()
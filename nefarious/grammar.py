@@ -5,12 +5,13 @@ from .lex import Word, Lexer
 
 from .tree import *
 from .builtins import Builtin
+from . import vm
 
 
 
 #---------------
 
-from .parser import Grammar, Rule, grammar_parse
+from .parser import Grammar, Rule, grammar_parse, NULL_WS
 
 def between(thing, symbols):
     assert len(symbols)
@@ -35,21 +36,53 @@ class Macro:
 
     # TODO fix the above erroneous description
 
+    # Macros which change the grammar when built. They're built at the end of
+    # each line, so they take effect straight away; cf. Column.evaluate().
+    # They override build_in(), to get the ParseSession they're changing.
+    has_effects = False
+
     def build(self, children, type_):
         raise NotImplementedError
 
-    def enter(self, children, type_):
-        grammar.save()
+    def build_in(self, session, children, type_):
+        return self.build(children, type_)
+
+    def enter(self, session, children, type_):
+        session.save()
 
-    def exit(self, children, type_):
-        grammar.restore()
+    def exit(self, session, children, type_):
+        session.restore()
 
 # TODO CustomMacros
 #    return self.call_immediate(children)
 
 
+# The built-in grammar. Programs are parsed in a ParseSession over it, so once
+# it's frozen it doesn't change.
 grammar = Grammar()
 
+
+class ParseSession(Grammar):
+    """The state of parsing one program: its own rules, over the base grammar.
+
+    A long-lived process can parse any number of programs, each in its own
+    session, without rebuilding the base grammar or leaking rules between them.
+
+    """
+    def __init__(self, base=None):
+        Grammar.__init__(self, grammar if base is None else base)
+
+        # The `define`s we're inside, innermost last; cf. DefineMacro.
+        self.definitions = [] # Name
+        self.definition_args = [] # [Symbol]
+
+        # The `fun`s we're inside; cf. LambdaMacro.
+        self.lambda_args = [] # [Symbol]
+
+    def parse(self, source, debug=False):
+        return grammar_parse(source, self, debug)
+
+
 def singleton(cls):
     return cls()
 
@@ -70,10 +103,11 @@ class Select(Macro):
 @singleton
 class Null(Macro):
     def build(self, values, type_):
-        return WordNode(Word.NULL_WS)
-# whitespace is always optional, but only permitted if it appears in the defition.
-# eg. "Int <> Int" would not allow a space between < and >.
-grammar.add(Word.WS, [], Null)
+        return NULL_WS
+# Word.WS in a rule is optional whitespace, and Word.WS_NOT_NULL is required;
+# the parser handles both itself, cf. Column.add(). Whitespace is only permitted
+# where it appears in the definition: eg. "Int <> Int" would not allow a space
+# between < and >.
 
 
 # Internal whitespace helpers
@@ -95,27 +129,54 @@ grammar.add(Internal.SEP, [Internal.SEP, Word.NL], Null)
 
 # List -- After all, this is "Nefarious Scheme"
 
+class ListBuilder(Node):
+    """Parse-time list of nodes, for Seq and Repeat rules.
+
+    Earley can keep several derivations alive which extend the same prefix, so
+    a ListBuilder is a view (buffer, length) onto a shared, append-only buffer.
+    Appending to the newest view extends the buffer in place; appending to an
+    older view copies its prefix first. No view ever sees its items change.
+
+    """
+    def __init__(self, buffer, length):
+        Node.__init__(self)
+        assert isinstance(buffer, list)
+        assert 0 <= length <= len(buffer)
+        self.buffer = buffer
+        self.length = length
+
+    def append(self, item):
+        buffer = self.buffer
+        length = self.length
+        if len(buffer) != length:
+            assert length >= 0
+            buffer = buffer[:length]
+        buffer.append(item)
+        return ListBuilder(buffer, length + 1)
+
+    def items(self):
+        length = self.length
+        assert length >= 0
+        return self.buffer[:length]
+
 @singleton
 class EmptyList(Macro):
     def build(self, values, type_):
-        return ListLiteral([], type_)
+        return ListBuilder([], 0)
 @singleton
 class StartList(Macro):
     def build(self, values, type_):
-        return ListLiteral([values[0]], type_)
+        return ListBuilder([values[0]], 1)
 @singleton
 class PairList(Macro):
     def build(self, values, type_):
-        return ListLiteral([values[0], values[-1]], type_)
+        return ListBuilder([values[0], values[-1]], 2)
 @singleton
 class ContinueList(Macro):
     def build(self, values, type_):
         list_ = values[0]
-        # TODO problem putting a Call at the top of a Block?
-        assert isinstance(list_, ListLiteral), type_
-        items = list(list_.items)
-        items.append(values[-1])
-        return ListLiteral(items, type_)
+        assert isinstance(list_, ListBuilder), type_
+        return list_.append(values[-1])
 
 
 # Generic lists
@@ -135,8 +196,8 @@ class ListMacro(Macro):
     def build(self, values, type_):
         # TODO some kind of type unification on items?
         list_ = values[2]
-        assert isinstance(list_, ListLiteral)
-        return ListLiteral(list_.items, type_) # TODO redundant!
+        assert isinstance(list_, ListBuilder)
+        return ListLiteral(list_.items(), type_)
 grammar.add(List.get(ALPHA), [
     Word.word("["), Internal.SEP, Repeat.get(ALPHA), Internal.SEP, Word.word("]"),
 ], ListMacro)
@@ -179,7 +240,7 @@ def Block(nodes):
 class BlockMacro(Macro):
     def build(self, values, type_):
         children = values[2]
-        items = children.items if isinstance(children, ListLiteral) else [children]
+        items = children.items() if isinstance(children, ListBuilder) else [children]
         return Block(items)
 
 grammar.add(Type.BLOCK, [Word.word("{"), Internal.SEP, Seq.get(Line), Internal.SEP, Word.word("}")], BlockMacro)
@@ -196,8 +257,8 @@ grammar.add(Type.BLOCK, [Word.word("{"), Word.word("}")], EmptyBlock)
 class Program(Macro):
     def build(self, values, type_):
         list_ = values[1]
-        assert isinstance(list_, ListLiteral)
-        return Sequence(list_.items)
+        assert isinstance(list_, ListBuilder)
+        return Sequence(list_.items())
 grammar.add(Type.PROGRAM, [Internal.SEP, Seq.get(Line), Internal.SEP], Program)
 
 
@@ -239,23 +300,22 @@ grammar.add(Seq.get(Spec), [Seq.get(Spec), Spec], ContinueList)
 
 @singleton
 class DefineMacro(Macro):
-    current_definitions = []
-    current_definition_args = []
+    has_effects = True
 
     def _is_arg(self, word):
         return isinstance(word, ArgSpec)
 
     def _get_spec(self, values):
         spec = values[2]
-        assert isinstance(spec, ListLiteral)
-        symbols = list(spec.items)
-        return symbols
+        assert isinstance(spec, ListBuilder)
+        return spec.items()
 
     def _arg_type(self, s):
         return s.type
 
-    def enter(self, values, type_):
-        grammar.save()
+    def enter(self, session, values, type_):
+        assert isinstance(session, ParseSession)
+        session.save()
         spec = self._get_spec(values)
 
         # Build name
@@ -268,7 +328,7 @@ class DefineMacro(Macro):
                 assert isinstance(s, WordNode)
                 debug_name += s.word.value
         func = Name(debug_name)
-        DefineMacro.current_definitions.append(func)
+        session.definitions.append(func)
 
         # Define arguments
         args = []
@@ -276,18 +336,19 @@ class DefineMacro(Macro):
             if isinstance(s, ArgSpec):
                 arg = Symbol.from_word(s.word)
                 type_ = self._arg_type(s)
-                grammar.add(type_, [s.word], LoadMacro(arg, type_))
+                session.add_binding(type_, [s.word], LoadMacro(arg, type_))
                 args.append(arg)
-        DefineMacro.current_definition_args.append(args)
+        session.definition_args.append(args)
 
         # Add internal (recursive) rule
         symbols, macro = self._macro(spec, func)
-        grammar.add(ALPHA, symbols, macro)
+        session.add(ALPHA, symbols, macro)
 
-    def exit(self, values, type_):
-        grammar.restore()
+    def exit(self, session, values, type_):
+        assert isinstance(session, ParseSession)
+        session.restore()
         spec = self._get_spec(values)
-        func = DefineMacro.current_definitions[-1]
+        func = session.definitions[-1]
 
         # Type check
         body = values[-1]
@@ -312,14 +373,14 @@ class DefineMacro(Macro):
             node, = body.nodes
             assert isinstance(node, Builtin)
             arg_indexes = []
-            arg_names = DefineMacro.current_definition_args[-1]
+            arg_names = session.definition_args[-1]
             for index, arg in enumerate(node._args()):
                 assert isinstance(arg, Load)
                 arg_indexes.append(arg_names.index(arg.name))
             arg_arg_indexes = [index for index, s in enumerate(spec) if self._is_arg(s)]
             macro = BuiltinMacro(node.__class__, [arg_arg_indexes[i] for i in arg_indexes])
 
-        grammar.add(type_, symbols, macro)
+        session.add(type_, symbols, macro)
 
     def _macro(self, spec, func):
         symbols = []
@@ -332,9 +393,10 @@ class DefineMacro(Macro):
         arg_indexes = [index for index, s in enumerate(spec) if self._is_arg(s)]
         return symbols, CallMacro(func, arg_indexes)
 
-    def build(self, values, type_):
-        name = DefineMacro.current_definitions.pop()
-        arg_names = DefineMacro.current_definition_args.pop()
+    def build_in(self, session, values, type_):
+        assert isinstance(session, ParseSession)
+        name = session.definitions.pop()
+        arg_names = session.definition_args.pop()
         body = values[4]
         assert isinstance(body, Lambda)
         body = body.body
@@ -373,19 +435,19 @@ grammar.add(Seq.get(Arg), ws([Seq.get(Arg), Arg]), ContinueList)
 
 @singleton
 class LambdaMacro(Macro):
-    current_definition_args = []
+    has_effects = True
 
     def _get_spec(self, values):
         # cf. DefineMacro::_get_spec()
         spec = values[2]
-        assert isinstance(spec, ListLiteral)
-        symbols = list(spec.items)
-        return symbols
+        assert isinstance(spec, ListBuilder)
+        return spec.items()
 
-    def enter(self, values, type_):
+    def enter(self, session, values, type_):
+        assert isinstance(session, ParseSession)
         spec = self._get_spec(values)
 
-        grammar.save()
+        session.save()
 
         # Define arguments
         args = []
@@ -394,16 +456,17 @@ class LambdaMacro(Macro):
             arg = Symbol.from_word(s.word)
             if DefineMacro._arg_type(s) != s.type:
                 raise SyntaxError("lambda can't have Block or Uneval arguments")
-            grammar.add(s.type, [s.word], LoadMacro(arg, s.type))
+            session.add_binding(s.type, [s.word], LoadMacro(arg, s.type))
             args.append(arg)
-        LambdaMacro.current_definition_args.append(args)
+        session.lambda_args.append(args)
 
-    def exit(self, values, type_):
-        grammar.restore()
+    def exit(self, session, values, type_):
+        session.restore()
         # TODO type check etc
 
-    def build(self, values, type_):
-        arg_names = LambdaMacro.current_definition_args.pop()
+    def build_in(self, session, values, type_):
+        assert isinstance(session, ParseSession)
+        arg_names = session.lambda_args.pop()
         body = values[4]
         assert isinstance(body, Lambda)
         body = body.body
@@ -449,25 +512,28 @@ class LoadMacro(Macro):
 
 @singleton
 class LetMacro(Macro):
-    def build(self, values, type_):
+    has_effects = True
+
+    def build_in(self, session, values, type_):
         value = values[6]
 
         iden = values[2]
-        assert isinstance(iden, ListLiteral)
+        assert isinstance(iden, ListBuilder)
         identifier = []
-        for v in iden.items:
+        for v in iden.items():
             assert isinstance(v, WordNode)
             identifier.append(v.word)
         name = ""
-        for iden in identifier:
-            name += iden.value
+        for word in identifier:
+            assert isinstance(word, Word)
+            name += word.value
         ref = Name(name) # TODO Symbol?
 
         type_ = value.type
         if type_ is None:
             type_ = Generic.ALPHA # TODO this doesn't work
 
-        grammar.add(type_, identifier, LoadMacro(ref, type_))
+        session.add_binding(type_, identifier, LoadMacro(ref, type_))
         return Let(ref, value)
 
 grammar.add(Seq.get(Iden), [Iden], StartList)
@@ -484,10 +550,12 @@ Var = Internal.get("Var")
 
 @singleton
 class Declare(Macro):
-    def build(self, values, type_):
+    has_effects = True
+
+    def build_in(self, session, values, type_):
         list_ = values[2]
-        assert isinstance(list_, ListLiteral)
-        identifier = list_.items
+        assert isinstance(list_, ListBuilder)
+        identifier = list_.items()
         assert isinstance(identifier, list)
         name = ""
         symbols = []
@@ -497,7 +565,7 @@ class Declare(Macro):
             name += iden.word.value
 
         ref = Name(name)
-        grammar.add(Var, symbols, LoadMacro(ref, Var))
+        session.add_binding(Var, symbols, LoadMacro(ref, Var))
 
         if len(values) > 3:
             value = values[7]
@@ -581,7 +649,7 @@ class PairMacro(Macro):
         return KVPair(Symbol.get(key.value), value)
 grammar.add(Pair, [Word.word(":"), Word.WORD, Word.WS_NOT_NULL, Type.ANY], PairMacro)
 
-grammar.add(Seq.get(Pair), [], EmptyList)
+# nb. not nullable: `[]` is an empty List, and an empty Record is `[:]`.
 grammar.add(Seq.get(Pair), [Pair], StartList)
 grammar.add(Seq.get(Pair), [Seq.get(Pair), Internal.SEP, Pair], ContinueList)
 
@@ -591,10 +659,10 @@ Record = Type.get('Record')
 class RecordMacro(Macro):
     def build(self, values, type_):
         pairs = values[2]
-        assert isinstance(pairs, ListLiteral)
+        assert isinstance(pairs, ListBuilder)
         keys = []
         values = []
-        for p in pairs.items:
+        for p in pairs.items():
             assert isinstance(p, KVPair)
             keys.append(p.key)
             values.append(p.value)
@@ -690,14 +758,10 @@ grammar.add(Int, [Word.DIGITS], ParseInt)
 @singleton
 class ParseFloat(Macro):
     def build(self, values, type_):
-        string = ""
-        for word in values:
-            assert isinstance(word, WordNode)
-            string += word.word.value
-        return Literal(W_Float.fromstr(string), type_)
-grammar.add(Float, [Word.DIGITS, Word.word("."), Word.DIGITS], ParseFloat)
-grammar.add(Float, [Word.DIGITS, Word.word("."), Word.DIGITS, Word.word("e"), Word.word("+"), Word.DIGITS], ParseFloat)
-grammar.add(Float, [Word.DIGITS, Word.word("."), Word.DIGITS, Word.word("e"), Word.word("-"), Word.DIGITS], ParseFloat)
+        number, = values
+        assert isinstance(number, WordNode)
+        return Literal(W_Float.fromstr(number.word.value), type_)
+grammar.add(Float, [Word.FLOAT], ParseFloat)
 
 @singleton
 class ParseText(Macro):
@@ -748,20 +812,27 @@ for name in dir(builtins):
         if cls is not Builtin and issubclass(cls, Builtin):
             add_builtin(cls)
 
+# Everything after this is added by programs.
+grammar.freeze()
+
 
 
 # TODO
 
 def parse(source, debug=False):
-    tree = grammar_parse(source, grammar, debug)
+    return show_tree(ParseSession().parse(source, debug))
+
+def show_tree(tree):
     assert isinstance(tree, Node)
     if isinstance(tree, Error):
         return tree.message
     return tree.sexpr()
 
-def parse_and_run(source, debug=False, inlining=True):
+def parse_and_run(source, debug=False, inlining=True, use_vm=False):
+    return run_tree(ParseSession().parse(source, debug), inlining, use_vm)
+
+def run_tree(tree, inlining=True, use_vm=False):
     Options.INLINING = inlining
-    tree = grammar_parse(source, grammar, debug)
     assert isinstance(tree, Node)
     if isinstance(tree, Error):
         return tree.message
@@ -778,7 +849,10 @@ def parse_and_run(source, debug=False, inlining=True):
 
     root = Frame(None, shape)
 
-    retval = tree.evaluate(root)
+    if use_vm:
+        retval = vm.run(tree, root)
+    else:
+        retval = tree.evaluate(root)
     if retval is None:
         print "=> None"
         return ""
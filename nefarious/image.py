@@ -0,0 +1,167 @@
+"""Snapshots of the grammar after a preamble, for fast startup.
+
+`nfs --save-image IMAGE preamble.nfs` parses the preamble, and saves the rules
+it added to its ParseSession (its `define`s, `let`s and `var`s), together with
+its tree. `nfs --image IMAGE program.nfs` adds those rules back -- without
+running any macros -- then parses the program, and runs the preamble's tree
+followed by the program's.
+
+Like the parse cache, we store trees from before compile(). The preamble is
+compiled together with the program, so its definitions can still be inlined.
+
+"""
+from .types import Type
+from .tree import Sequence
+from .grammar import CallMacro, BuiltinMacro, LoadMacro
+from .cache import (CacheError, BUILTINS, Writer, Reader, grammar_fingerprint,
+        md5, read_file, write_file)
+from .parser import IntSort
+
+
+MAGIC = "NFSI"
+
+# Bump this when the format changes.
+VERSION = 1
+
+
+class Image:
+    def __init__(self, tree, names, digest):
+        assert isinstance(tree, Sequence)
+        self.tree = tree
+        self.names = names # Names, in the order the image saw them
+        self.digest = digest
+
+    def prepend(self, tree):
+        """The program `tree`, run after the preamble."""
+        assert isinstance(tree, Sequence)
+        return Sequence(self.tree.nodes + tree.nodes)
+
+
+def new_rules(grammar, mark):
+    """Rules added to the current scope since highest_priority was `mark`."""
+    by_priority = {}
+    scope = grammar.scope
+    rules = []
+    for target in scope.rule_sets:
+        rules += scope.rule_sets[target]
+    for word in scope.bindings:
+        rules += scope.bindings[word]
+    for rule in rules:
+        if rule.priority > mark:
+            by_priority[rule.priority] = rule
+    priorities = by_priority.keys()
+    IntSort(priorities).sort()
+    return [by_priority[priority] for priority in priorities]
+
+
+# Files
+
+def save(filename, fingerprint, tree, rules):
+    """Write an image.
+
+    fingerprint must be taken from the grammar before the preamble was parsed.
+
+    """
+    try:
+        write_file(filename, dumps(fingerprint, tree, rules))
+    except OSError:
+        raise CacheError("can't write image " + filename)
+
+def load(filename, grammar):
+    """Add the rules from an image to grammar, and return the Image."""
+    try:
+        data = read_file(filename)
+    except OSError:
+        raise CacheError("can't read image " + filename)
+    return loads(data, grammar)
+
+
+# Serialisation
+
+def dumps(fingerprint, tree, rules):
+    assert isinstance(tree, Sequence)
+    out = Writer()
+    out.raw(MAGIC)
+    out.uint(VERSION)
+    out.string(fingerprint)
+    out.node(tree)
+    out.uint(len(rules))
+    for rule in rules:
+        out.tag(rule.target)
+        out.uint(len(rule.symbols))
+        for symbol in rule.symbols:
+            out.tag(symbol)
+        macro(out, rule.call)
+    return out.getvalue()
+
+def loads(data, grammar):
+    reader = Reader(data)
+    if reader.raw(len(MAGIC)) != MAGIC:
+        raise CacheError("not an image")
+    if reader.uint() != VERSION:
+        raise CacheError("image has the wrong version")
+    if reader.string() != grammar_fingerprint(grammar):
+        raise CacheError("image was saved by a different nfs")
+    tree = reader.node()
+    if not isinstance(tree, Sequence):
+        raise CacheError("bad image")
+
+    # Read everything before touching the grammar, in case the image is bad.
+    rules = []
+    for i in range(reader.uint()):
+        target = reader.tag()
+        if not isinstance(target, Type):
+            raise CacheError("bad rule")
+        symbols = [reader.tag() for j in range(reader.uint())]
+        rules.append((target, symbols, read_macro(reader)))
+    if reader.pos != len(data):
+        raise CacheError("trailing data")
+
+    for target, symbols, call in rules:
+        if isinstance(call, LoadMacro):
+            grammar.add_binding(target, symbols, call)
+        else:
+            grammar.add(target, symbols, call)
+    return Image(tree, reader.names, md5(data))
+
+
+# Macros. Only those which definitions add to the grammar can appear.
+
+def macro(out, call):
+    if isinstance(call, CallMacro):
+        out.raw("c")
+        out.name(call.call)
+        indexes(out, call.arg_indexes)
+    elif isinstance(call, BuiltinMacro):
+        out.raw("b")
+        out.string(call.cls.__name__)
+        indexes(out, call.arg_indexes)
+    elif isinstance(call, LoadMacro):
+        out.raw("l")
+        out.name(call.name)
+        out.type(call.type)
+    else:
+        raise CacheError("can't save rule")
+
+def indexes(out, arg_indexes):
+    out.uint(len(arg_indexes))
+    for index in arg_indexes:
+        out.uint(index)
+
+def read_macro(reader):
+    tag = reader.byte()
+    if tag == "c":
+        name = reader.name()
+        return CallMacro(name, read_indexes(reader))
+    elif tag == "b":
+        name = reader.string()
+        if name not in BUILTINS:
+            raise CacheError("unknown builtin")
+        return BuiltinMacro(BUILTINS[name], read_indexes(reader))
+    elif tag == "l":
+        name = reader.name()
+        return LoadMacro(name, reader.type())
+    raise CacheError("bad macro")
+
+def read_indexes(reader):
+    return [reader.uint() for i in range(reader.uint())]
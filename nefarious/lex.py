@@ -1,5 +1,6 @@
 
 from .types import Tag
+from .source import Text
 
 # TODO Digit tokens
 
@@ -7,6 +8,7 @@ from .types import Tag
 class Word(Tag):
     _cache = {}
     has_generic = False
+    _immutable_fields_ = ['kind', 'value', 'has_value']
 
     def __init__(self, kind, value=""):
         self.kind = kind
@@ -27,7 +29,7 @@ class Word(Tag):
         assert isinstance(kind, str)
         assert isinstance(value, str)
         if value:
-            assert kind in ('RESERVED', 'PUNC', 'DIGITS', 'TEXT', 'WORD', 'ERROR', 'WS'), value
+            assert kind in ('RESERVED', 'PUNC', 'DIGITS', 'FLOAT', 'TEXT', 'WORD', 'ERROR', 'WS'), value
         key = kind, value
         if key in Word._cache:
             word = Word._cache[key]
@@ -62,90 +64,180 @@ class Word(Tag):
     def sexpr(self):
         return self.value if self.has_value else self.kind
 
+    def lookahead(self):
+        """Tags this token can be scanned as. cf. Column.scan()"""
+        if self.has_value:
+            return [self, Word.get(self.kind)]
+        elif self is Word.WS:
+            return [self, Word.WS_NOT_NULL]
+        return [self]
+
+
+# Character classes, for Lexer; indexed by ord(c).
+(C_WORD, C_NL, C_SPACE, C_ERROR, C_RESERVED, C_PUNC, C_DIGIT,
+ C_QUOTE) = range(8)
+
+CLASSES = [C_WORD] * 256 # letters, `_`, and anything non-ASCII
+CLASSES[ord("\n")] = C_NL
+CLASSES[ord(" ")] = C_SPACE
+for c in "\t\f\r":
+    CLASSES[ord(c)] = C_ERROR
+for c in ":{}":
+    CLASSES[ord(c)] = C_RESERVED
+for c in "-!#$%&\\'()*+,./;<=>?@[]^`|~":
+    CLASSES[ord(c)] = C_PUNC
+for c in "0123456789":
+    CLASSES[ord(c)] = C_DIGIT
+CLASSES[ord('"')] = C_QUOTE
+
 
 class Lexer:
-    def __init__(self, source):
-        self.source = source
-        self.length = len(source)
-        self.index = 0
-        self.tok = source[0]
-
-    def next(self):
-        self.index += 1
-        if self.index < self.length:
-            self.tok = self.source[self.index]
-        else:
-            self.tok = ''
+    """Splits source into Words.
+
+    Each token is found as a span, `start` to `end`, of the source; which is
+    only sliced when the token has a value we need. Spaces, newlines and
+    punctuation never are.
+
+    """
+    def __init__(self, source, index=0):
+        if isinstance(source, str):
+            source = Text(source)
+        self.source = source # a Source
+        self.length = source.length
+        self.index = index
+        self.start = index # span of the last token
+        self.end = index
+
+    def _class(self, index):
+        return CLASSES[ord(self.source.char(index))]
+
+    def _skip(self, cls):
+        source = self.source
+        index = self.index
+        while index < self.length and CLASSES[ord(source.char(index))] == cls:
+            index += 1
+        self.index = index
+
+    def _at(self, index, cls):
+        return index < self.length and self._class(index) == cls
+
+    def _char(self, index):
+        return self.source.char(index) if index < self.length else "\0"
 
     def lex(self):
-        if self.tok == '':
+        self.start = self.index
+        token = self._lex()
+        self.end = self.index
+        return token
+
+    def _lex(self):
+        if self.index >= self.length:
             return Word.EOF
+        c = self.source.char(self.index)
+        cls = CLASSES[ord(c)]
 
-        elif self.tok == '\n':
-            self.next()
-            while self.tok == ' ':
-                self.next()
+        if cls == C_NL:
+            self.index += 1
+            self._skip(C_SPACE)
             return Word.NL
 
-        elif self.tok == ' ':
-            self.next()
-            while self.tok == ' ':
-                self.next()
-            if self.tok == '\n':
-                self.next()
-                while self.tok == ' ':
-                    self.next()
+        elif cls == C_SPACE:
+            self._skip(C_SPACE)
+            if self._at(self.index, C_NL):
+                self.index += 1
+                self._skip(C_SPACE)
                 return Word.NL
             return Word.WS
 
-        elif self.tok in '\t\f\r':
-            c = self.tok
-            self.next()
-            # error
-            return Word.get('ERROR', c)
-
-        elif self.tok in ":{}":
-            c = self.tok
-            self.next()
-            return Word.get('RESERVED', c)
-
-        elif self.tok in "-!#$%&\\'()*+,./;<=>?@[]^`|~":
-            c = self.tok
-            self.next()
-            return Word.get('PUNC', c)
-
-        elif self.tok in "0123456789":
-            s = self.tok
-            self.next()
-            while self.tok in "0123456789":
-                s += self.tok
-                self.next()
-            return Word('DIGITS', s) # Don't unique digit tokens.
-
-        elif self.tok == '"':
-            s = ""
-            self.next() # quote
-            while self.tok != '"':
-                if self.tok == '\\':
-                    self.next()
-                s += self.tok
-                self.next()
-            self.next() # quote
-            return Word('TEXT', s) # Don't unique string tokens.
+        elif cls == C_ERROR or cls == C_RESERVED or cls == C_PUNC:
+            self.index += 1
+            return SYMBOLS[ord(c)]
+
+        elif cls == C_DIGIT:
+            start = self.index
+            self._skip(C_DIGIT)
+            if self._float():
+                return Word('FLOAT', self.source.slice(start, self.index))
+            # Don't unique digit tokens.
+            return Word('DIGITS', self.source.slice(start, self.index))
+
+        elif cls == C_QUOTE:
+            return Word('TEXT', self._text()) # Don't unique string tokens.
 
         # TODO _
         else:
-            s = self.tok
-            self.next()
-            while self.tok not in " \n\t\f\r:{}-!\"#$%&\\'()*+,./;<=>?@[]^`|~":
-                s += self.tok
-                self.next()
-            return Word.get('WORD', s)
+            source = self.source
+            start = self.index
+            index = start + 1
+            while index < self.length:
+                cls = CLASSES[ord(source.char(index))]
+                if cls != C_WORD and cls != C_DIGIT:
+                    break
+                index += 1
+            self.index = index
+            return Word.get('WORD', source.slice(start, index))
+
+    def _float(self):
+        """After some digits, skip the rest of a float: `.5` or `.5e-3`."""
+        index = self.index
+        if not (self._char(index) == "." and self._at(index + 1, C_DIGIT)):
+            return False
+        self.index = index + 1
+        self._skip(C_DIGIT)
+        index = self.index
+        if (self._char(index) == "e" and
+                (self._char(index + 1) == "+" or self._char(index + 1) == "-")
+                and self._at(index + 2, C_DIGIT)):
+            self.index = index + 2
+            self._skip(C_DIGIT)
+        return True
+
+    def _text(self):
+        """Skip a quoted string, and return what's inside."""
+        self.index += 1 # quote
+        start = self.index
+        escaped = False
+        while self.index < self.length:
+            c = self.source.char(self.index)
+            if c == '"':
+                break
+            if c == '\\':
+                escaped = True
+                self.index += 1
+            self.index += 1
+        end = min(self.index, self.length)
+        self.index = end + 1 # quote
+        if not escaped:
+            return self.source.slice(start, end)
+
+        # Rare, so it's fine to build it a character at a time.
+        s = ""
+        index = start
+        while index < end:
+            if self.source.char(index) == '\\':
+                index += 1
+                if index == end:
+                    break
+            s += self.source.char(index)
+            index += 1
+        return s
+
+    def show(self, start, end):
+        """The tokens from start to end, as error messages quote lines."""
+        lexer = Lexer(self.source, start)
+        line = ""
+        while lexer.index < end:
+            token = lexer.lex()
+            if token is Word.EOF:
+                break
+            if token is Word.WS:
+                line += " "
+            elif token is not Word.NL:
+                line += token.value
+        return line
 
     @staticmethod
     def tokenize(text):
-        if not text: # TODO we shouldn't have to special-case this
-            return []
         tokens = []
         lexer = Lexer(text)
         token = lexer.lex()
@@ -167,6 +259,7 @@ Word.WS_NOT_NULL = Word.get('WS', '  ')
 Word.RESERVED = Word.get('RESERVED')
 Word.PUNC = Word.get('PUNC')
 Word.DIGITS = Word.get('DIGITS')
+Word.FLOAT = Word.get('FLOAT')
 Word.TEXT = Word.get('TEXT')
 Word.WORD = Word.get('WORD')
 Word.ERROR = Word.get('ERROR')
@@ -174,3 +267,13 @@ Word.ERROR = Word.get('ERROR')
 Word.ENTER = Word.word("{")
 Word.EXIT = Word.word("}")
 
+# The token for each punctuation character, so lexing them doesn't allocate.
+SYMBOLS = [None] * 256
+for i in range(256):
+    if CLASSES[i] == C_ERROR:
+        SYMBOLS[i] = Word.get('ERROR', chr(i))
+    elif CLASSES[i] == C_RESERVED:
+        SYMBOLS[i] = Word.get('RESERVED', chr(i))
+    elif CLASSES[i] == C_PUNC:
+        SYMBOLS[i] = Word.get('PUNC', chr(i))
+
@@ -4,35 +4,86 @@
 from .types import *
 from .lex import Word, Lexer
 
+from rpython.rlib.listsort import make_timsort_class
+
+IntSort = make_timsort_class() # no list.sort() in RPython
+
 
 DEBUG = False
 
+# Default for `wants.get()`, so misses don't allocate. Never mutate it!
+NO_ITEMS = []
+
+# The value of optional whitespace which wasn't there. WordNodes don't track
+# their parent, so this can be shared.
+NULL_WS = WordNode(Word.NULL_WS)
+
+
+class Counters:
+    """How much work the parser did. Shown by `nfs --stats`."""
+    def __init__(self):
+        self.specialised_rules = 0
+        self.unify_hits = 0
+        self.unify_misses = 0
+        self.pruned_items = 0
+
+    def show(self):
+        return ("specialised rules: " + str(self.specialised_rules) + "\n" +
+                "unify hits: " + str(self.unify_hits) + "\n" +
+                "unify misses: " + str(self.unify_misses) + "\n" +
+                "pruned items: " + str(self.pruned_items) + "\n")
+
+counters = Counters()
+
+
+class Signature(object):
+    """A rule's target and symbols, interned by its Grammar.
+
+    Rules with the same Signature always match the same spans; so only the one
+    with the highest priority can ever win, cf. Item.add_derivation().
+
+    Signatures form a trie, with ROOT at the top; see Grammar.signature().
+
+    """
+    __slots__ = []
+
+Signature.ROOT = Signature()
+
+
 class Rule:
-    def __init__(self, target, symbols, call):
+    _immutable_fields_ = ['target', 'symbols', 'signature', 'lr0s[*]',
+                          'first', 'first_word', 'call']
+
+    def __init__(self, target, symbols, call, signature=None):
         assert isinstance(symbols, list)
         for s in symbols:
             assert isinstance(s, Tag)
         self.symbols = symbols
         assert isinstance(target, Tag)
         self.target = target
+        self.signature = signature # None for specialised rules
 
+        # Specialised rules are hash-consed: see specialise().
         self._specialise = {}
+        self.origin = self # the rule this was specialised from
+        self.bindings = {} # Generic index -> Type, relative to origin
 
         # TODO if target is Generic, same Generic must appear somewhere in
         # symbols.
 
-        self.lr0s = []
-        if symbols:
-            self.first = previous = LR0(self, 0)
-            self.lr0s.append(self.first)
-            for dot in range(1, len(symbols)):
-                lr0 = LR0(self, dot)
-                self.lr0s.append(lr0)
-                previous.advance = lr0
-                previous = lr0
-            previous.advance = target
-        else:
-            self.first = target
+        # Built back to front, so each LR0 knows what it advances to.
+        lr0s = [None] * len(symbols)
+        advance = target
+        for dot in range(len(symbols) - 1, -1, -1):
+            advance = lr0s[dot] = LR0(self, dot, advance)
+        self.lr0s = lr0s
+        self.first = advance
+
+        # For lookahead-filtered prediction: the terminal every derivation of
+        # this rule starts with, if any. Word.WS is nullable, so doesn't count.
+        self.first_word = None
+        if symbols and isinstance(symbols[0], Word) and symbols[0] is not Word.WS:
+            self.first_word = symbols[0]
 
         self.priority = 0
         from .grammar import Macro
@@ -43,12 +94,23 @@ class Rule:
         return "<{} -> {}>".format(self.target, " ".join(map(str, self.symbols)))
 
     def specialise(self, unification):
-        rule = self
-        indexes = unification.values.keys()
-        # TODO sort indexes
+        """The rule with some of its generics bound.
+
+        We always bind generics to the origin rule in index order, so the same
+        bindings give the same Rule (and LR0s), however we got there; so items
+        for it are merged, rather than duplicated in each column.
+
+        """
+        values = self.bindings.copy()
+        for index in unification.values:
+            values[index] = unification.values[index]
+        if len(values) == len(self.bindings):
+            return self
+        indexes = values.keys()
+        IntSort(indexes).sort()
+        rule = self.origin
         for index in indexes:
-            type_ = unification.values[index]
-            rule = rule._specialise_once(index, type_)
+            rule = rule._specialise_once(index, values[index])
         return rule
 
     def _specialise_once(self, index, type_):
@@ -62,16 +124,23 @@ class Rule:
         rule = Rule(target, symbols, self.call)
         rule.priority = self.priority # this is important.
         # however it surprised me that I'd remembered to do this!
+        rule.origin = self.origin
+        rule.bindings = self.bindings.copy()
+        rule.bindings[index] = type_
         self._specialise[key] = rule
+        counters.specialised_rules += 1
         return rule
 
 
 class LR0(Tag):
-    def __init__(self, rule, dot):
+    _immutable_fields_ = ['rule', 'wants', 'advance', 'dot']
+
+    def __init__(self, rule, dot, advance):
         self.rule = rule
         self.wants = rule.symbols[dot]
-        self.advance = None # set by Rule
+        self.advance = advance # the next LR0, or the target
         self.dot = dot
+        self._unified = {} # completed tag -> specialised LR0, or None
 
     def __repr__(self):
         symbols = list(self.rule.symbols)
@@ -81,8 +150,43 @@ class LR0(Tag):
     def specialise(self, unification):
         return self.rule.specialise(unification).lr0s[self.dot]
 
+    def unify(self, tag):
+        """Specialise, to advance over a completed `tag`.
+
+        Returns None if tag doesn't unify with what we want.
+
+        """
+        if tag in self._unified:
+            counters.unify_hits += 1
+            return self._unified[tag]
+        counters.unify_misses += 1
+        lr0 = None
+        unification = self.wants.is_super(tag)
+        if unification:
+            lr0 = self.specialise(unification)
+        self._unified[tag] = lr0
+        return lr0
+
+
+class Derivation(object):
+    __slots__ = ['left', 'right', 'rule', 'leo']
+    _immutable_fields_ = ['left', 'right', 'rule', 'leo']
+
+    def __init__(self, left, right, rule, leo=None):
+        self.left = left
+        self.right = right
+        self.rule = rule
+        self.leo = leo # LeoPath, if right hasn't been built yet
+
+
+# Item.effects
+UNKNOWN, PURE, EFFECTS = 0, 1, 2
+
+class Item(object):
+    __slots__ = ['tag', 'start', 'derivation', 'inside', 'value', 'children',
+                 'effects']
+    _immutable_fields_ = ['tag', 'start']
 
-class Item:
     def __init__(self, start, tag):
         assert isinstance(tag, Tag), tag
         self.tag = tag
@@ -91,22 +195,20 @@ class Item:
         # TODO cache wanted_by
         # TODO for generic LHSes, cache (a subset of?) column.wants
 
-        # derivation
-        self.left = None
-        self.right = None
-        self.rule = None
+        # Most items are never completed, so this is only allocated when a
+        # derivation is added.
+        self.derivation = None
 
         # evaluation
         self.inside = False
         self.value = None
         self.children = None
+        self.effects = UNKNOWN
 
-    def add_derivation(self, left, right, rule):
-        if self.rule and self.rule.priority >= rule.priority:
+    def add_derivation(self, left, right, rule, leo=None):
+        if self.derivation and self.derivation.rule.priority >= rule.priority:
             return
-        self.left = left
-        self.right = right
-        self.rule = rule
+        self.derivation = Derivation(left, right, rule, leo)
 
     def __repr__(self):
         return "<Item: {!r}, {!r})>".format(self.start.index, self.tag)
@@ -115,84 +217,261 @@ class Item:
         # nb. We don't cache children for intermediate nodes; we only cache the
         # value of completed nodes. So we-ll re-do building the list. This is
         # fine, because otherwise we'd end up copying the list anyway.
-        if isinstance(self.tag, LR0) and self.tag.dot == 0:
+        tag = self.tag
+        if isinstance(tag, LR0) and tag.dot == 0:
             return []
 
         if self.children is not None:
             return list(self.children) # copy
 
-        item = self
+        # Build the children depth-first, with an explicit stack rather than
+        # recursion, so deep nesting and long lines don't overflow.
+        root = self._evaluation()
+        todo = [root]
+        while todo:
+            evaluation = todo[-1]
+            if not evaluation.subs:
+                todo.pop()
+                if todo:
+                    item = evaluation.item
+                    value = item._build(evaluation.rule, evaluation.children, stack)
+                    todo[-1].children.append(value)
+                continue
+
+            item = evaluation.subs.pop().right
+            if item.value is None:
+                # cf. evaluate()
+                stack.append(item)
+                assert item.derivation is not None, "item RHS evaluated to None"
+                if item.children is None:
+                    todo.append(item._evaluation())
+                    continue
+                item._build(item.derivation.rule, list(item.children), stack)
+            evaluation.children.append(item.value)
+
+        return root.children
+
+    def _evaluation(self):
+        derivation = self.derivation
+        rule = derivation.rule if derivation is not None else None
+        if derivation is not None and derivation.leo is not None:
+            derivation = self.derivation = Derivation(derivation.left,
+                    derivation.leo.expand(), derivation.rule)
+
         subs = []
-        while item.left:
-            subs.append(item)
-            item = item.left
+        while derivation and derivation.left:
+            subs.append(derivation)
+            derivation = derivation.left.derivation
 
         self.children = children = []
-        for item in reversed(subs):
-            child = item.right.evaluate(stack)
-            assert child is not None, "item RHS evaluated to None"
-            children.append(child)
+        return Evaluation(self, rule, subs, children)
+
+    def has_effects(self):
+        """Would building the value change the grammar?
 
-        return children
+        ie. does the derivation use a Macro with has_effects. Only valid once
+        the item's column is finished, so its derivation can't change.
+
+        """
+        if self.value is not None:
+            return False # already happened
+        if self.effects != UNKNOWN:
+            return self.effects == EFFECTS
+
+        # Search the derivation, without recursing; cf. evaluate_children().
+        # Items are marked PURE as we go, which also stops cycles.
+        seen = []
+        todo = [self]
+        effects = False
+        while todo and not effects:
+            item = todo.pop()
+            if item.value is not None or item.effects == PURE:
+                continue
+            if item.effects == EFFECTS:
+                effects = True
+                break
+            item.effects = PURE
+            seen.append(item)
+
+            derivation = item.derivation
+            if derivation is not None and derivation.rule.call.has_effects:
+                effects = True
+                break
+            while derivation is not None:
+                if derivation.right is not None:
+                    todo.append(derivation.right)
+                if derivation.leo is not None:
+                    derivation.leo.skipped(todo)
+                derivation = derivation.left.derivation if derivation.left else None
+
+        if effects:
+            # we stopped early, so don't know about the rest
+            for item in seen:
+                item.effects = UNKNOWN
+            self.effects = EFFECTS
+        return effects
 
     def evaluate(self, stack):
         if self.value is not None:
             return self.value
         stack.append(self)
-        rule = self.rule
-        if not rule: # token
+        if not self.derivation: # token
             return self.value
+        rule = self.derivation.rule
 
         children = self.evaluate_children(stack)
+        return self._build(rule, children, stack)
 
-        value = rule.call.build(children, rule.target)
+    def _build(self, rule, children, stack):
+        # nb. `rule` is from before evaluating the children, since a cycle
+        # might have built this item already.
+        value = rule.call.build_in(self.start.grammar, children, rule.target)
         assert isinstance(value, Node), (value, rule.call)
 
         self.value = value
         assert stack.pop() == self
+
+        # Only the value is needed from now on. Dropping the derivation lets
+        # the earlier Columns and Items be freed as we go.
+        if not self.inside:
+            self.derivation = None
+            self.children = None
         return value
 
     def eval_enter(self):
         assert self.inside == False
 
+        rule = self.derivation.rule
         children = self.evaluate_children([])
-        while len(children) < len(self.rule.symbols):
+        while len(children) < len(rule.symbols):
             children.append(None)
 
-        self.rule.call.enter(children, self.rule.target)
+        rule.call.enter(self.start.grammar, children, rule.target)
 
     def eval_exit(self):
         assert self.inside == True
         self.inside = False
 
+        rule = self.derivation.rule
         children = self.evaluate_children([])
-        while len(children) < len(self.rule.symbols):
+        while len(children) < len(rule.symbols):
             children.append(None)
 
-        self.rule.call.exit(children, self.rule.target)
+        rule.call.exit(self.start.grammar, children, rule.target)
+
+
+class Evaluation(object):
+    """An Item whose children are being built; cf. Item.evaluate_children()."""
+    __slots__ = ['item', 'rule', 'subs', 'children']
+
+    def __init__(self, item, rule, subs, children):
+        self.item = item
+        self.rule = rule
+        self.subs = subs # Derivations whose right is still to build; last first
+        self.children = children
+
+
+class TransitiveItem(object):
+    """Leo's deterministic reduction path, for a tag in a finished Column.
+
+    When exactly one item in the column wants the tag, and it's waiting on its
+    last symbol, then completing the tag can only ever complete that item;
+    which might in turn do the same for `above`. So right-recursive rules would
+    complete a whole chain of items at each step. Instead, we skip straight to
+    the item at the `top`.
 
+    """
+    __slots__ = ['left', 'above', 'top']
+    _immutable_fields_ = ['left', 'above', 'top']
+
+    def __init__(self, left, above):
+        assert isinstance(left, Item)
+        self.left = left
+        self.above = above
+        self.top = above.top if above else self
+
+
+class LeoPath(object):
+    """A derivation which skipped the items on a TransitiveItem chain.
+
+    They're only built if the derivation is evaluated.
+
+    """
+    __slots__ = ['column', 'transitive', 'right']
+    _immutable_fields_ = ['column', 'transitive', 'right']
+
+    def __init__(self, column, transitive, right):
+        self.column = column
+        self.transitive = transitive
+        self.right = right
+
+    def skipped(self, items):
+        """Add the items whose values expand() would use."""
+        items.append(self.right)
+        transitive = self.transitive
+        while transitive is not transitive.top:
+            items.append(transitive.left)
+            transitive = transitive.above
+
+    def expand(self):
+        right = self.right
+        transitive = self.transitive
+        while transitive is not transitive.top:
+            left = transitive.left
+            lr0 = left.tag
+            assert isinstance(lr0, LR0)
+            item = self.column.detached(left.start, lr0.advance)
+            item.add_derivation(left, right, lr0.rule)
+            right = item
+            transitive = transitive.above
+        return right
+
+
+class Column(object):
+    __slots__ = ['grammar', 'index', 'items', 'unique', 'wants', 'transitive',
+                 'lookahead', 'predicted']
+    _immutable_fields_ = ['grammar', 'index']
 
-class Column:
     def __init__(self, grammar, index):
         self.grammar = grammar
         self.index = index
         self.items = []
-        self.unique = {}
+        self.unique = {} # tag -> {start.index -> item}
         self.wants = {}
+        self.transitive = {} # tag -> TransitiveItem or None
+        self.lookahead = None # tags the next token scans as; see Word.lookahead()
+        self.predicted = {} # tags we've predicted; only needed during process()
 
     def has(self, start, tag):
         assert isinstance(start, Column)
-        key = start, tag
-        if key in self.unique:
-            return self.unique[key]
+        if tag in self.unique:
+            by_start = self.unique[tag]
+            if start.index in by_start:
+                return by_start[start.index]
+        return None
+
+    def detached(self, start, tag):
+        """Like add(), but the item won't be processed."""
+        assert isinstance(start, Column)
+        if tag in self.unique:
+            by_start = self.unique[tag]
+        else:
+            by_start = self.unique[tag] = {}
+        if start.index in by_start:
+            return by_start[start.index]
+        item = by_start[start.index] = Item(start, tag)
+        return item
 
     def add(self, start, tag):
         assert isinstance(start, Column)
-        key = start, tag
-        if key in self.unique:
-            return self.unique[key]
+        if tag in self.unique:
+            by_start = self.unique[tag]
+        else:
+            by_start = self.unique[tag] = {}
+        if start.index in by_start:
+            return by_start[start.index]
 
-        item = self.unique[key] = Item(start, tag)
+        item = by_start[start.index] = Item(start, tag)
         self.items.append(item)
 
         if isinstance(tag, LR0):
@@ -201,11 +480,73 @@ class Column:
                 if type_ in self.wants:
                     wanted_by = self.wants[type_]
                 else:
-                    wanted_by = self.wants[type_] = {}
-                wanted_by[item] = None
+                    wanted_by = self.wants[type_] = []
+                wanted_by.append(item) # nb. items are unique
+
+            # If what we want can be empty, skip over it straight away; so it
+            # doesn't matter whether its empty completion has already been
+            # processed (Aycock & Horspool). Optional whitespace is always
+            # skipped this way, rather than predicting an empty rule.
+            # (WS_NOT_NULL is required, and anywhere else whitespace is
+            # forbidden; both of which fall out of scan().)
+            wants = tag.wants
+            if wants is Word.WS:
+                self._complete(item, self.null_ws())
+            elif wants in self.grammar.null_rules:
+                right = self.null(wants)
+                if right is not None:
+                    self._complete(item, right)
 
         return item
 
+    def null_ws(self):
+        item = self.detached(self, Word.NULL_WS)
+        item.value = NULL_WS
+        return item
+
+    def null(self, tag):
+        """The empty completion of `tag` in this column.
+
+        Derived with the rule which first made it nullable, so building it
+        can't loop; cf. Grammar.null_rules.
+
+        """
+        rule = self.grammar.null_rules[tag]
+        if rule.symbols:
+            # add() skips over each (nullable) symbol in turn
+            self.add(self, rule.first)
+        else:
+            item = self.add(self, rule.target)
+            item.add_derivation(None, None, rule)
+        return self.has(self, rule.target)
+
+    def get_transitive(self, tag):
+        # Only valid once this column is finished!
+        if tag in self.transitive:
+            return self.transitive[tag]
+        self.transitive[tag] = None # in case of cycles
+        if tag == Type.BLOCK:
+            return None # need to set `inside`
+
+        left = None
+        for type_ in tag.supertypes():
+            for item in self.wants.get(type_, NO_ITEMS):
+                if left is not None:
+                    return None # ambiguous
+                left = item
+        if left is None:
+            return None
+        lr0 = left.tag
+        assert isinstance(lr0, LR0)
+        if isinstance(lr0.advance, LR0): # not the last symbol
+            return None
+        if lr0.wants.has_generic or lr0.rule.target.has_generic:
+            return None
+
+        above = left.start.get_transitive(lr0.advance)
+        transitive = self.transitive[tag] = TransitiveItem(left, above)
+        return transitive
+
     def scan(self, word, previous):
         assert isinstance(word, Word)
         assert len(self.items) == 0
@@ -213,6 +554,8 @@ class Column:
             if word in previous.wants:
                 item = self.add(previous, word)
                 item.value = WordNode(word)
+            for rule in self.grammar.bindings(word):
+                self._scan_binding(previous, word, rule)
             token = Word.get(word.kind)
         else:
             token = word
@@ -224,40 +567,90 @@ class Column:
             item.value = WordNode(word)
         return len(self.items) > 0
 
+    def _scan_binding(self, previous, word, rule):
+        # Does anything want it? cf. complete()
+        for tag in rule.target.supertypes():
+            if tag in previous.wants:
+                break
+        else:
+            return
+
+        # As if we'd predicted the rule and scanned the word.
+        token = self.detached(previous, word)
+        if token.value is None:
+            token.value = WordNode(word)
+        item = self.add(previous, rule.target)
+        item.add_derivation(Item(previous, rule.first), token, rule)
+
     def predict(self, tag):
         # Look for items that target any *subtype* of tag.
 
         for type_ in tag.subtypes():
-            self._predict(type_)
+            if type_ not in self.predicted:
+                self._predict(type_)
 
     def _predict(self, tag):
-        for rule in self.grammar.get(tag):
-            item = self.add(self, rule.first)
+        core = self.grammar.core
+        if core is None:
+            self.predicted[tag] = None
+            for rule in self.grammar.predict(tag, self.lookahead):
+                self._add_predicted(rule)
+            return
 
-            # nullables need a value!
-            if not isinstance(rule.first, LR0) and rule.call: # is nullable
-                item.rule = rule
+        # Add the whole closure for the core rules at once, cf. Core; and
+        # predict the rest as usual, for each tag in it.
+        for type_, rules in core.closure(tag, self.lookahead):
+            if type_ in self.predicted:
+                continue
+            self.predicted[type_] = None
+            for rule in rules:
+                self._add_predicted(rule)
+            if self.grammar.has_dynamic(type_):
+                for rule in self.grammar.predict_dynamic(type_, self.lookahead):
+                    self._add_predicted(rule)
+
+    def _add_predicted(self, rule):
+        item = self.add(self, rule.first)
+
+        # nullables need a value!
+        if not isinstance(rule.first, LR0): # is empty
+            item.add_derivation(None, None, rule)
 
     def complete(self, right):
         # Look for items that want any *supertype* of right.
 
+        if right.start is not self:
+            transitive = right.start.get_transitive(right.tag)
+            if transitive is not None:
+                self._leo_complete(transitive, right)
+                return
+
         wants = right.start.wants
 
         for tag in right.tag.supertypes():
-            for left in wants.get(tag, {}):
+            for left in wants.get(tag, NO_ITEMS):
                 self._complete(left, right)
 
+    def _leo_complete(self, transitive, right):
+        left = transitive.top.left
+        lr0 = left.tag
+        assert isinstance(lr0, LR0)
+        new = self.add(left.start, lr0.advance)
+        if transitive.top is transitive:
+            new.add_derivation(left, right, lr0.rule)
+        else:
+            new.add_derivation(left, None, lr0.rule,
+                    LeoPath(self, transitive, right))
+
     def _complete(self, left, right):
         lr0 = left.tag
+        assert isinstance(lr0, LR0)
         if lr0.wants.has_generic:
-            # unify generic
-            unification = lr0.wants.is_super(right.tag)
-            if not unification:
+            # unify generic, and specialise the rule, including its target
+            old, lr0 = lr0, lr0.unify(right.tag)
+            if lr0 is None:
                 return
 
-            # specialise the rule, including its target
-            old, lr0 = lr0, lr0.specialise(unification)
-
             if old.rule.target.has_generic:
                 # after specialising, make sure the new rule can itself be
                 # completed! (that is, somebody wants the specialised target).
@@ -275,15 +668,40 @@ class Column:
 
     def process(self):
         for item in self.items:
-            if isinstance(item.tag, LR0):
-                self.predict(item.tag.wants)
+            tag = item.tag
+            if isinstance(tag, LR0):
+                if not isinstance(tag.wants, Word): # terminals are scanned
+                    self.predict(tag.wants)
             else:
                 self.complete(item)
+        self.predicted = {}
 
     def evaluate(self):
+        """Build completed items which change the grammar, eg. definitions.
+
+        Everything else is left until it's needed for the Program, so we don't
+        build trees for alternatives which never get used.
+
+        """
         for item in self.items:
             if not isinstance(item.tag, LR0): # complete
-                item.evaluate([])
+                if item.tag is Type.PROGRAM:
+                    continue # only built once, at EOF
+                if item.has_effects():
+                    item.evaluate([])
+
+    def expected(self):
+        """Words which could have come next. Only used for error messages."""
+        words = {}
+        for tag in self.wants:
+            if isinstance(tag, Word):
+                words[tag] = None
+            # include rules skipped by lookahead-filtered prediction
+            for word in self.grammar.first_words(tag):
+                words[word] = None
+        for word in self.grammar.binding_words(self.wants):
+            words[word] = None
+        return words.keys()
 
     def eval_enter(self):
         if Type.BLOCK not in self.wants:
@@ -291,8 +709,9 @@ class Column:
             raise ValueError()
 
         for item in self.wants[Type.BLOCK]:
-            assert isinstance(item.tag, LR0)
-            assert item.tag.wants == Type.BLOCK
+            tag = item.tag
+            assert isinstance(tag, LR0)
+            assert tag.wants == Type.BLOCK
             item.eval_enter()
 
     def eval_exit(self):
@@ -311,10 +730,57 @@ class Column:
 
 
 class Grammar:
-    def __init__(self):
+    def __init__(self, base=None):
+        """An empty grammar; or a layer over base, starting with its rules.
+
+        A layer shares base's scopes, but only ever changes its own; so base
+        mustn't change once it has layers. Each program is parsed in a layer
+        over the built-in grammar; cf. ParseSession.
+
+        """
         self.scope = Scope()
-        self.stack = [self.scope]
-        self.highest_priority = 0
+        self.base = base
+
+        # Interned Signatures: trie edges added by this grammar, so they're
+        # dropped along with it. Layers look in base's first.
+        self.signatures = {} # (Signature, Tag) -> Signature
+
+        if base is None:
+            self.stack = [self.scope]
+            self.shared = 0
+            self.highest_priority = 0
+
+            # Rules for each target, merged across the stack. Rebuilt lazily
+            # when the target's version changes.
+            self.rule_sets = {} # target -> RuleSet
+            self.versions = {} # target -> int
+
+            # Once frozen, the rules so far are predicted using the Core; the
+            # rest with these, which leave the Core's rules out.
+            self.core = None
+            self.dynamic_rule_sets = {} # target -> RuleSet
+
+            # Tags which can be empty, merged across the stack; cf.
+            # Scope.nullables
+            self.null_rules = {} # tag -> Rule
+        else:
+            self.stack = base.stack + [self.scope]
+            self.shared = len(base.stack) # scopes which belong to base
+            self.highest_priority = base.highest_priority
+
+            # RuleSets are never changed once built, so we can start with
+            # base's; changing a target bumps our version, not base's.
+            self.rule_sets = base.rule_sets.copy()
+            self.versions = base.versions.copy()
+            self.core = base.core
+            self.dynamic_rule_sets = base.dynamic_rule_sets.copy()
+            self.null_rules = base.null_rules.copy()
+
+    def freeze(self):
+        """The rules so far are the core grammar, and won't change."""
+        assert len(self.stack) == 1
+        self.core = Core(self.scope, self.highest_priority, self.versions)
+        self.dynamic_rule_sets = {}
 
     def save(self):
         assert self.stack[-1] is self.scope
@@ -324,31 +790,180 @@ class Grammar:
 
     def restore(self):
         assert self.stack[-1] is self.scope
-        self.stack.pop()
+        assert len(self.stack) > self.shared + 1, "can't pop a shared scope"
+        scope = self.stack.pop()
         self.scope = self.stack[-1]
         assert self.stack[-1] is self.scope
 
+        for target in scope.rule_sets:
+            self.changed(target)
+        if scope.nullables:
+            self._merge_nullables()
+
+    def changed(self, target):
+        self.versions[target] = self.versions.get(target, 0) + 1
+
+    def version(self, target):
+        return self.versions.get(target, 0)
+
     # Rules
 
     def add(self, target, symbols, call):
-        rule = Rule(target, symbols, call)
+        # Words are terminals; even optional whitespace is handled by Column.
+        assert not isinstance(target, Word)
+        rule = Rule(target, symbols, call, self.signature(target, symbols))
         self.highest_priority += 1
         rule.priority = self.highest_priority
 
         for target in rule.target.supertypes():
             self.scope.add(target, rule)
+            self.changed(target)
+
+        if rule.target not in self.null_rules and self._is_empty(rule):
+            self._find_nullables(len(self.stack) - 1)
         return rule
 
-    def remove(self, rule):
+    def add_binding(self, target, symbols, call):
+        """Add a rule for a variable or argument, eg. `Int -> x`.
+
+        Single-word rules are kept in a table on the scope, and matched in
+        Column.scan() rather than predicted; so having lots of variables in
+        scope doesn't make predicting their types any slower.
+
+        """
+        word = symbols[0] if len(symbols) == 1 else None
+        if not isinstance(word, Word) or not word.has_value:
+            return self.add(target, symbols, call)
+        rule = Rule(target, symbols, call, self.signature(target, symbols))
+        self.highest_priority += 1
+        rule.priority = self.highest_priority
+        self.scope.add_binding(rule)
+        return rule
+
+    def signature(self, target, symbols):
+        signature = self._then(Signature.ROOT, target)
+        for tag in symbols:
+            signature = self._then(signature, tag)
+        return signature
+
+    def _then(self, signature, tag):
+        key = (signature, tag)
+        grammar = self
+        while grammar is not None:
+            if key in grammar.signatures:
+                return grammar.signatures[key]
+            grammar = grammar.base
+        result = self.signatures[key] = Signature()
+        return result
+
+    def bindings(self, word):
         for scope in reversed(self.stack):
+            if word in scope.bindings:
+                for rule in scope.bindings[word]:
+                    yield rule
+
+    def binding_words(self, tags):
+        """Words bound to a subtype of one of tags. For error messages."""
+        words = []
+        for scope in self.stack:
+            for word in scope.bindings:
+                for rule in scope.bindings[word]:
+                    for tag in rule.target.supertypes():
+                        if tag in tags:
+                            words.append(word)
+        return words
+
+    def remove(self, rule):
+        """Remove a rule from whichever of our own scopes has it."""
+        for depth in range(len(self.stack) - 1, self.shared - 1, -1):
+            scope = self.stack[depth]
+            if scope.remove_binding(rule):
+                return
             if scope.remove(rule):
+                for target in rule.target.supertypes():
+                    self.changed(target)
+                if self.core is not None and rule.priority <= self.core.priority:
+                    self.core = Core(self.stack[0], self.core.priority,
+                            self.versions)
+                if rule.target in self.null_rules:
+                    # start again, in case that was the only way to be empty
+                    for depth in range(self.shared, len(self.stack)):
+                        self.stack[depth].nullables = {}
+                    self._merge_nullables()
+                    for depth in range(self.shared, len(self.stack)):
+                        self._find_nullables(depth)
                 return
 
-    def get(self, target):
+    # Nullables
+
+    def _is_empty(self, rule):
+        """Can rule match nothing, given the nullables we know about?"""
+        if rule.target.has_generic:
+            return False # we'd need to unify, to know what it's an empty *what*
+        for symbol in rule.symbols:
+            if symbol is not Word.WS and symbol not in self.null_rules:
+                return False
+        return True
+
+    def _find_nullables(self, depth):
+        """Add newly-nullable tags to the scope at depth.
+
+        Goes round until nothing changes, since each nullable target might make
+        more rules nullable. This only happens when a rule could be empty,
+        which is rare, so it doesn't matter that we look at every rule.
+
+        """
+        scope = self.stack[depth]
+        changed = True
+        while changed:
+            changed = False
+            for i in range(depth + 1):
+                outer = self.stack[i]
+                for target in outer.rule_sets:
+                    for rule in outer.rule_sets[target]:
+                        if rule.target in self.null_rules:
+                            continue
+                        if not self._is_empty(rule):
+                            continue
+                        # What wants a supertype can be completed by an empty
+                        # target; cf. Column.complete()
+                        for tag in rule.target.supertypes():
+                            if tag not in self.null_rules:
+                                scope.nullables[tag] = rule
+                                self.null_rules[tag] = rule
+                        changed = True
+
+    def _merge_nullables(self):
+        # Outermost first: rules from outer scopes were added earlier, so
+        # this keeps the oldest rule for each tag, which Column.null() needs.
+        self.null_rules = {}
+        for scope in self.stack:
+            for tag in scope.nullables:
+                if tag not in self.null_rules:
+                    self.null_rules[tag] = scope.nullables[tag]
+
+    def get_rule_set(self, target):
+        return self._get_rule_set(self.rule_sets, target, 0)
+
+    def get_dynamic_rule_set(self, target):
+        """Like get_rule_set(), but without the Core's rules."""
+        return self._get_rule_set(self.dynamic_rule_sets, target,
+                self.core.priority)
+
+    def _get_rule_set(self, rule_sets, target, floor):
+        version = self.version(target)
+        if target in rule_sets:
+            rule_set = rule_sets[target]
+            if rule_set.version == version:
+                return rule_set
+        rule_set = rule_sets[target] = RuleSet(version)
         for scope in reversed(self.stack):
-            if target in scope.rule_sets:
-                for rule in scope.rule_sets[target]:
-                    yield rule
+            rule_set.extend(scope, target, floor)
+        rule_set.prune()
+        return rule_set
+
+    def get(self, target):
+        return self.get_rule_set(target).rules
 
         # # specialise target for container types. (I think?)
         # if isinstance(target, List) and not target.has_generic:
@@ -360,18 +975,44 @@ class Grammar:
         #         for m in matches:
         #             yield m.specialise(unification)
 
-        # matches = []
-        # for scope in reversed(self.stack):
-        #     if target in scope.rule_sets:
-        #         matches += scope.rule_sets[target]
-        # for m in matches:
-        #     yield m
+    def predict(self, target, lookahead):
+        """Rules for target which could start with one of the lookahead tags.
 
-    def is_nullable(self, target):
-        for scope in reversed(self.stack):
-            if target in scope.nullables:
-                return True
-        return False
+        Rules starting with a non-terminal (or nullable) are always included.
+        If lookahead is None, this is the same as get().
+
+        """
+        return self._predict(self.get_rule_set(target), lookahead)
+
+    def has_dynamic(self, target):
+        """Might target have rules which aren't in the Core?"""
+        return self.version(target) != self.core.versions.get(target, 0)
+
+    def predict_dynamic(self, target, lookahead):
+        """Like predict(), but without the Core's rules."""
+        return self._predict(self.get_dynamic_rule_set(target), lookahead)
+
+    def _predict(self, rule_set, lookahead):
+        if lookahead is None:
+            for rule in rule_set.rules:
+                yield rule
+            return
+        for rule in rule_set.unindexed:
+            yield rule
+        counters.pruned_items += rule_set.pruned
+        index = rule_set.first_words
+        for word in lookahead:
+            if word in index:
+                for rule in index[word]:
+                    yield rule
+            if word in rule_set.pruned_words:
+                counters.pruned_items += rule_set.pruned_words[word]
+
+    def first_words(self, target):
+        return self.get_rule_set(target).first_words.keys()
+
+    def is_nullable(self, tag):
+        return tag is Word.WS or tag in self.null_rules
 
     def generics(self):
         for scope in reversed(self.stack):
@@ -379,57 +1020,319 @@ class Grammar:
                 yield rule
 
 
+class RuleSet:
+    """The rules for one target, from every Scope on the stack.
+
+    Innermost scope first; each scope's rules in the order they were added.
+
+    """
+    def __init__(self, version):
+        self.version = version
+        self.rules = []
+        self.unindexed = []
+        self.first_words = {} # first_word -> [rule]
+
+        # How many rules prune() dropped from unindexed / first_words.
+        self.pruned = 0
+        self.pruned_words = {} # first_word -> int
+
+    def extend(self, scope, target, floor=0):
+        """Add scope's rules for target, except those with priority <= floor."""
+        if target not in scope.rule_sets:
+            return
+        if floor:
+            for rule in scope.rule_sets[target]:
+                if rule.priority > floor:
+                    self.add(rule)
+            return
+        self.rules += scope.rule_sets[target]
+        if target in scope.unindexed:
+            self.unindexed += scope.unindexed[target]
+        if target in scope.first_words:
+            index = scope.first_words[target]
+            for word in index:
+                if word not in self.first_words:
+                    self.first_words[word] = []
+                self.first_words[word] += index[word]
+
+    def add(self, rule):
+        self.rules.append(rule)
+        word = rule.first_word
+        if word is None:
+            self.unindexed.append(rule)
+        else:
+            if word not in self.first_words:
+                self.first_words[word] = []
+            self.first_words[word].append(rule)
+
+    def prune(self):
+        """Don't predict rules shadowed by a newer rule with the same symbols.
+
+        eg. after redefining `Int:a + Int:b`, the old definition can only ever
+        lose to the new one, so it's not worth building items for it.
+
+        """
+        best = {} # Signature -> Rule
+        shadowed = False
+        for rule in self.rules:
+            if len(rule.symbols) == 0:
+                continue # nullables don't make items worth pruning
+            if rule.signature in best:
+                shadowed = True
+                if best[rule.signature].priority >= rule.priority:
+                    continue
+            best[rule.signature] = rule
+        if not shadowed:
+            return
+
+        unindexed = []
+        for rule in self.unindexed:
+            if rule.signature in best and best[rule.signature] is not rule:
+                self.pruned += 1
+            else:
+                unindexed.append(rule)
+        self.unindexed = unindexed
+
+        for word in self.first_words:
+            rules = []
+            pruned = 0
+            for rule in self.first_words[word]:
+                if best[rule.signature] is not rule:
+                    pruned += 1
+                else:
+                    rules.append(rule)
+            if pruned:
+                self.first_words[word] = rules
+                self.pruned_words[word] = pruned
+
+
+class Core:
+    """The rules added before Grammar.freeze(): the built-in grammar.
+
+    Those never change, so predicting a tag always adds the same items for
+    them. So we work out the whole closure -- the tags it predicts, the tags
+    their rules want, and so on -- once for each tag and lookahead, rather than
+    item by item in every column. That's roughly a state of the LR(0)
+    automaton. Rules added later (definitions, lets, inner scopes) are
+    predicted as usual, for each tag in the closure.
+
+    A core rule shadowed by a later one is still predicted; the later one wins
+    anyway, cf. Item.add_derivation().
+
+    """
+    def __init__(self, scope, priority, versions):
+        self.priority = priority
+        self.versions = versions.copy() # cf. Grammar.has_dynamic()
+        self.rule_sets = {} # target -> RuleSet
+        self.words = {} # first word of any core rule -> None
+        for target in scope.rule_sets:
+            rule_set = RuleSet(0)
+            for rule in scope.rule_sets[target]:
+                if rule.priority <= priority:
+                    rule_set.add(rule)
+            rule_set.prune()
+            self.rule_sets[target] = rule_set
+            for word in rule_set.first_words:
+                self.words[word] = None
+
+        self.closures = {} # lookahead word -> {tag -> [(tag, [rule])]}
+
+    def closure(self, tag, lookahead):
+        """Each tag predicting `tag` would predict, with its core rules.
+
+        In the order the items would've been added.
+
+        """
+        word = lookahead[0]
+        if word not in self.words:
+            word = lookahead[-1] # so only its kind matters
+        if word in self.closures:
+            closures = self.closures[word]
+        else:
+            closures = self.closures[word] = {}
+        if tag in closures:
+            return closures[tag]
+        closure = closures[tag] = self._closure(tag, lookahead)
+        return closure
+
+    def _closure(self, tag, lookahead):
+        closure = []
+        seen = {tag: None}
+        todo = [tag]
+        i = 0
+        while i < len(todo):
+            tag = todo[i]
+            i += 1
+            rules = self._predict(tag, lookahead)
+            closure.append((tag, rules))
+            for rule in rules:
+                first = rule.first
+                if not isinstance(first, LR0):
+                    continue
+                wants = first.wants
+                if isinstance(wants, Word):
+                    continue # terminals are scanned
+                for type_ in wants.subtypes():
+                    if type_ not in seen:
+                        seen[type_] = None
+                        todo.append(type_)
+        return closure
+
+    def _predict(self, tag, lookahead):
+        # cf. Grammar.predict()
+        if tag not in self.rule_sets:
+            return []
+        rule_set = self.rule_sets[tag]
+        rules = list(rule_set.unindexed)
+        for word in lookahead:
+            if word in rule_set.first_words:
+                rules += rule_set.first_words[word]
+        return rules
+
+
 class Scope:
     def __init__(self):
         self.rule_sets = {}
-        self.nullables = {}
+        self.nullables = {} # tag -> the Rule which first made it nullable
+
+        # rule_sets, split for prediction:
+        self.unindexed = {} # target -> [rule]
+        self.first_words = {} # target -> {first_word -> [rule]}
+
+        # Variables; see Grammar.add_binding()
+        self.bindings = {} # word -> [rule]
 
     def add(self, target, rule):
         if target not in self.rule_sets:
             self.rule_sets[target] = []
         self.rule_sets[target].append(rule)
 
-        if len(rule.symbols) == 0:
-            self.nullables[target] = None
-
-    def remove(self, rule):
-        if rule.target in self.rule_sets:
-            rules = self.rule_sets[rule.target]
-            try:
-                rules.remove(rule)
-                return True
-            except IndexError:
-                pass
+        word = rule.first_word
+        if word is None:
+            if target not in self.unindexed:
+                self.unindexed[target] = []
+            self.unindexed[target].append(rule)
+        else:
+            if target not in self.first_words:
+                self.first_words[target] = {}
+            index = self.first_words[target]
+            if word not in index:
+                index[word] = []
+            index[word].append(rule)
+
+    def add_binding(self, rule):
+        word = rule.first_word
+        if word not in self.bindings:
+            self.bindings[word] = []
+        self.bindings[word].append(rule)
+
+    def remove_binding(self, rule):
+        word = rule.first_word
+        if word in self.bindings and rule in self.bindings[word]:
+            self.bindings[word].remove(rule)
+            return True
         return False
 
+    def remove(self, rule):
+        found = False
+        for target in rule.target.supertypes():
+            if target not in self.rule_sets:
+                continue
+            rules = self.rule_sets[target]
+            if rule not in rules:
+                continue
+            rules.remove(rule)
+            found = True
+
+            word = rule.first_word
+            if word is None:
+                self.unindexed[target].remove(rule)
+            else:
+                self.first_words[target][word].remove(rule)
+        return found
+
+
+
+def release(column, window):
+    """Free what nothing after `column` can refer back to.
+
+    A finished Column is only ever looked at again to complete something
+    which started there; so we only need keep the wants entries for the tags
+    which live items could complete. Every other finished Column in `window`
+    is emptied, letting the Items and Columns behind them be freed.
+
+    """
+    live = {} # Column -> {tag -> None}, or None for every tag
+    todo = list(column.items)
+    while todo:
+        item = todo.pop()
+        tag = item.tag
+        target = tag.rule.target if isinstance(tag, LR0) else tag
+        start = item.start
+        if start is column:
+            continue
+        if start in live:
+            tags = live[start]
+            if tags is None or target in tags:
+                continue
+        else:
+            tags = live[start] = {}
 
+        if target.has_generic:
+            # we don't know what it'll specialise to
+            live[start] = None
+            for wanted_by in start.wants.values():
+                todo += wanted_by
+        else:
+            for type_ in target.supertypes():
+                tags[type_] = None
+                if type_ in start.wants:
+                    todo += start.wants[type_]
+
+    for old in window:
+        if old is column:
+            continue
+        old.items = []
+        old.unique = {}
+        old.transitive = {}
+        if old not in live:
+            old.wants = {}
+            continue
+        tags = live[old]
+        if tags is not None:
+            wants = {}
+            for type_ in old.wants:
+                if type_ in tags:
+                    wants[type_] = old.wants[type_]
+            old.wants = wants
 
 
 def grammar_parse(source, grammar, debug=DEBUG):
     lexer = Lexer(source)
 
+    # Lex one token ahead, so prediction can skip rules which can't match it.
+    token = lexer.lex()
+    end = lexer.end # of token
+
     first = column = Column(grammar, 0)
-    column.wants[Type.PROGRAM] = {}
+    column.wants[Type.PROGRAM] = []
+    column.lookahead = token.lookahead()
     column.predict(Type.PROGRAM)
     column.process()
 
+    # Columns which haven't been released yet.
+    window = [column]
+
     #grammar.save()
 
-    token = lexer.lex()
     index = 0
-    line = ""
+    line_start = 0 # only quoted in error messages; cf. Lexer.show()
     lineno = 1
     previous = None
     while token != Word.EOF:
         if token == Word.NL:
             lineno += 1
 
-        if token != Word.NL:
-            if token == Word.WS:
-                line += " "
-            else:
-                line += token.value
-
         if debug:
             column.print_()
 
@@ -438,11 +1341,11 @@ def grammar_parse(source, grammar, debug=DEBUG):
                 column.eval_enter()
             except ValueError:
                 msg = "Unexpected BLOCK on line " + str(lineno)
-                msg += "\n>> " + line
+                msg += "\n>> " + lexer.show(line_start, end)
                 return Error(msg)
 
         if token == Word.NL: # end of line
-            line = ""
+            line_start = end
             # Evaluate things here, so macros take effect
             column.evaluate()
 
@@ -451,31 +1354,39 @@ def grammar_parse(source, grammar, debug=DEBUG):
             msg = "Unexpected " + token.kind + " on line " + str(lineno)
             if token.value:
                 msg += ": " + token.value
-            for token in previous.wants:
-                if isinstance(token, Word):
-                    msg += "\nExpected: " + token.sexpr()
-            msg += "\n>> " + line
+            for word in previous.expected():
+                msg += "\nExpected: " + word.sexpr()
+            msg += "\n>> " + lexer.show(line_start, end)
             return Error(msg)
+        next_token = lexer.lex()
+        column.lookahead = next_token.lookahead()
         column.process()
 
         if token == Word.EXIT: # } -> end of block
             column.eval_exit()
 
-        token = lexer.lex()
+        window.append(column)
+        program = column.has(first, Type.PROGRAM) if token == Word.NL else None
+        if program is not None:
+            # Top-level line: build it now, so we only need keep its value
+            program.evaluate_children([])
+            release(column, window)
+            window = [column]
+
+        token = next_token
+        end = lexer.end
         index += 1
 
     if debug:
         column.print_()
-    key = first, Type.PROGRAM
-    if key not in column.unique:
+    start = column.has(first, Type.PROGRAM)
+    if start is None:
         msg = "Unexpected EOF"
         if previous:
-            for token in previous.wants:
-                if isinstance(token, Word):
-                    msg += "\nExpected: " + token.sexpr()
-            msg += "\n>> " + line
+            for word in previous.expected():
+                msg += "\nExpected: " + word.sexpr()
+            msg += "\n>> " + lexer.show(line_start, end)
         return Error(msg)
-    start = column.unique[key]
     value = start.evaluate([])
 
     return value
@@ -0,0 +1,86 @@
+"""Program text, for the Lexer.
+
+Regular files are memory-mapped, so loading a big program doesn't copy it; the
+Lexer reads the mapping directly, and only slices out the tokens it needs.
+Anything else, eg. stdin, is read in chunks.
+
+Only once translated, though: on CPython every Source is read into a Text, so
+the tests never exercise Mapped.
+
+"""
+import os
+import stat
+
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rstring import StringBuilder
+from rpython.rlib import rmmap
+
+
+CHUNK = 65536
+
+
+class Source(object):
+    length = 0
+
+    def char(self, index):
+        raise NotImplementedError
+
+    def slice(self, start, end):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Text(Source):
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+
+    def char(self, index):
+        return self.text[index]
+
+    def slice(self, start, end):
+        assert 0 <= start <= end
+        return self.text[start:end]
+
+
+class Mapped(Source):
+    def __init__(self, fd, length):
+        self.map = rmmap.mmap(fd, length, access=rmmap.ACCESS_READ)
+        self.length = length
+
+    def char(self, index):
+        return self.map.getitem(index)
+
+    def slice(self, start, end):
+        return self.map.getslice(start, end - start)
+
+    def close(self):
+        self.map.close()
+
+
+def load(fd):
+    """The program in fd, which is closed."""
+    try:
+        if we_are_translated():
+            # On CPython, reading the mapping a character at a time is slow.
+            st = os.fstat(fd)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                try:
+                    return Mapped(fd, int(st.st_size))
+                except (rmmap.RMMapError, OSError):
+                    pass # read it instead
+        return Text(read(fd))
+    finally:
+        os.close(fd)
+
+def read(fd):
+    """Everything left in fd."""
+    builder = StringBuilder(CHUNK)
+    while True:
+        chunk = os.read(fd, CHUNK)
+        if len(chunk) == 0:
+            break
+        builder.append(chunk)
+    return builder.build()
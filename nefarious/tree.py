@@ -431,8 +431,8 @@ class StoreCell(Node):
 class Lambda(Node):
     type = Type.FUNC
 
-    __slots__ = Node.__slots__ + ['body', 'original_body', 'shape', '_arg_names']
-    _immutable_fields_ = ['body', 'original_body', 'shape', '_arg_names']
+    __slots__ = Node.__slots__ + ['body', 'original_body', 'shape', '_arg_names', 'code']
+    _immutable_fields_ = ['body', 'original_body', 'shape', '_arg_names', 'code?']
 
     def __init__(self, arg_names, body):
         Node.__init__(self)
@@ -445,6 +445,7 @@ class Lambda(Node):
         assert isinstance(body, Node)
         self.body = body
         self.original_body = None if body is None else body.copy()
+        self.code = None # for the VM; see vm.code_for()
 
     @jit.elidable
     def arg_length(self):
@@ -765,6 +766,7 @@ class StaticCall(Call):
         # Rewrite outer_func
         transform = ReplaceTransform(replace=self, with_=inlined)
         outer_func.body = outer_func.body.copy(transform)
+        outer_func.code = None
 
         # Fix outer_func's Frame shape.
         stack = frame.shape_stack()
@@ -869,10 +871,17 @@ class GenericCall(Call):
 
 
 class ClosureLoad(Node):
-    __slots__ = Node.__slots__ + ['name', 'closure_node']
-    _immutable_fields_ = ['name', 'closure_node']
+    __slots__ = Node.__slots__ + ['name', 'closure_node', 'shapes', 'index']
+    _immutable_fields_ = ['name', 'closure_node', 'shapes?[*]', 'index?']
 
-    """For inlining. Extracts a local variable from inside a Closure object."""
+    """For inlining. Extracts a local variable from inside a Closure object.
+
+    Remembers where it last found the name: the shape of every scope from the
+    closure's out to the one holding it, and the index there. Frames never
+    change shape or parent, so matching that chain means the name resolves
+    the same way again.
+
+    """
     def __init__(self, name, type_, closure_node):
         Node.__init__(self)
         assert isinstance(name, Name)
@@ -881,9 +890,8 @@ class ClosureLoad(Node):
         assert not closure_node._parent
         closure_node.set_parent(self)
         self.closure_node = closure_node # TODO make this a `name`
-
-        # self.index = index
-        # self.depth = depth
+        self.shapes = None
+        self.index = -1
 
     def _copy(self, transform): return ClosureLoad(self.name, self.type, self.closure_node.copy(transform))
     def children(self): return [self.closure_node]
@@ -903,19 +911,49 @@ class ClosureLoad(Node):
         assert isinstance(closure, Closure)
         scope = closure.scope
 
+        # shapes is quasi-immutable, so under the JIT this is just a guard on
+        # each scope's shape.
+        shapes = self.shapes
+        if shapes is not None:
+            target = scope
+            depth = len(shapes) - 1
+            i = 0
+            while target and target.shape is shapes[i]:
+                if i == depth:
+                    return target.lookup(self.index)
+                target = target.parent
+                i += 1
+        return self.resolve(scope)
+
+    @jit.unroll_safe
+    def resolve(self, scope):
         name = self.name
         jit.promote(name)
+        target = scope
         depth = 0
         while True:
-            index = scope.shape.lookup(name)
+            shape = target.shape
+            # shape is promoted, so under the JIT this is constant-folded.
+            jit.promote(shape)
+            index = shape.lookup(name)
             if index != -1:
-                return scope.lookup(index)
-            if not scope.parent:
+                break
+            if not target.parent:
                 raise ValueError(name)
-            scope = scope.parent
+            target = target.parent
             depth += 1
-
-        # TODO cache index/depth
+        if not jit.we_are_jitted():
+            # don't invalidate traces from inside one
+            self.remember(scope, depth, index)
+        return target.lookup(index)
+
+    def remember(self, scope, depth, index):
+        shapes = [None] * (depth + 1)
+        for i in range(depth + 1):
+            shapes[i] = scope.shape
+            scope = scope.parent
+        self.shapes = shapes
+        self.index = index
 
     def sexpr(self):
         return self.closure_node.sexpr() + "->" + self.name.sexpr()
@@ -985,16 +1023,59 @@ class Return(Node):
         return "(return " + self.child.sexpr() + ")"
 
 
+class FieldCache(object):
+    """Inline cache from record Shape to field index, for one GetAttr/SetAttr.
+
+    Holds up to LIMIT (shape, index) pairs. Once a node has seen more shapes
+    than that it's megamorphic, and just asks the Shape every time.
+
+    """
+    LIMIT = 4
+    _immutable_fields_ = ['symbol']
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.shapes = []
+        self.indexes = []
+        self.megamorphic = False
+
+    def index(self, shape):
+        # The node isn't always a trace constant, so neither is symbol.
+        symbol = jit.promote(self.symbol)
+        if jit.we_are_jitted():
+            # shape is promoted too, so this is constant-folded.
+            return shape.lookup(symbol)
+        return self._index(shape, symbol)
+
+    def _index(self, shape, symbol):
+        # Out of line: a loop here would stop the JIT inlining index().
+        shapes = self.shapes
+        for i in range(len(shapes)):
+            if shapes[i] is shape:
+                return self.indexes[i]
+        index = shape.lookup(symbol)
+        if not self.megamorphic:
+            if len(shapes) < FieldCache.LIMIT:
+                shapes.append(shape)
+                self.indexes.append(index)
+            else:
+                self.megamorphic = True
+                self.shapes = []
+                self.indexes = []
+        return index
+
+
 class GetAttr(Node):
     type = Generic.ALPHA
-    __slots__ = Node.__slots__ + ['symbol', 'record']
-    _immutable_fields_ = ['symbol', 'record']
+    __slots__ = Node.__slots__ + ['symbol', 'record', 'cache']
+    _immutable_fields_ = ['symbol', 'record', 'cache']
 
     def __init__(self, symbol, record):
         Node.__init__(self)
         self.symbol = symbol
         self.record = record
         record.set_parent(self)
+        self.cache = FieldCache(symbol)
 
     def _copy(self, transform): return GetAttr(self.symbol, self.record.copy(transform))
     def children(self): return [self.record]
@@ -1011,12 +1092,12 @@ class GetAttr(Node):
             print "not a record:", self.record.sexpr()
         assert isinstance(record, W_Record)
 
-        symbol = self.symbol
-        jit.promote(symbol)
+        return self.lookup(record)
+
+    def lookup(self, record):
         shape = record.shape
         jit.promote(shape)
-        index = shape.lookup(symbol)
-        # TODO cache shape->index, for the interpreter
+        index = self.cache.index(shape)
         return record.values[index]
 
     def sexpr(self):
@@ -1024,8 +1105,8 @@ class GetAttr(Node):
 
 
 class SetAttr(Node):
-    __slots__ = Node.__slots__ + ['symbol', 'record', 'value']
-    _immutable_fields_ = ['symbol', 'record', 'value']
+    __slots__ = Node.__slots__ + ['symbol', 'record', 'value', 'cache']
+    _immutable_fields_ = ['symbol', 'record', 'value', 'cache']
 
     def __init__(self, symbol, record, value):
         Node.__init__(self)
@@ -1034,6 +1115,7 @@ class SetAttr(Node):
         record.set_parent(self)
         self.value = value
         value.set_parent(self)
+        self.cache = FieldCache(symbol)
 
     def _copy(self, transform): return SetAttr(self.symbol, self.record.copy(transform), self.value.copy(transform))
     def children(self): return [self.record, self.value]
@@ -1053,13 +1135,12 @@ class SetAttr(Node):
 
         jit.promote(self.value)
         value = self.value.evaluate(frame)
+        self.store(record, value)
 
-        symbol = self.symbol
-        jit.promote(symbol)
+    def store(self, record, value):
         shape = record.shape
         jit.promote(shape)
-        index = shape.lookup(symbol)
-        # TODO cache shape->index, for the interpreter
+        index = self.cache.index(shape)
         record.values[index] = value
 
     def sexpr(self):
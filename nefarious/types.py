@@ -1,9 +1,20 @@
+try:
+    from rpython.rlib import jit
+except ImportError:
+    raise ImportError("Please run `make pypy`")
+
 
 class Tree:
     pass
 
 
 class Tag(Tree):
+    # The parser asks for these for nearly every item, so each tag works them
+    # out once. Types are interned, so this extends to new parametric types as
+    # they're created. Don't mutate the lists!
+    _supers = None
+    _subs = None
+
     def specialise(self, unification):
         return self
 
@@ -11,10 +22,24 @@ class Tag(Tree):
         if self is other:
             return Unification.EMPTY
 
+    @jit.elidable
     def supertypes(self):
-        return [self]
+        supers = self._supers
+        if supers is None:
+            supers = self._supers = self._supertypes()
+        return supers
 
+    @jit.elidable
     def subtypes(self):
+        subs = self._subs
+        if subs is None:
+            subs = self._subs = self._subtypes()
+        return subs
+
+    def _supertypes(self):
+        return [self]
+
+    def _subtypes(self):
         return [self]
 
 
@@ -94,10 +119,10 @@ class Type(Tag):
         if self is other:
             return Unification.EMPTY
 
-    def supertypes(self):
+    def _supertypes(self):
         return [Type.ANY, self]
 
-    def subtypes(self):
+    def _subtypes(self):
         return [self, Generic.ALPHA]
 
 
@@ -132,13 +157,13 @@ class List(Type):
     def specialise(self, unification):
         return List.get(self.child.specialise(unification))
 
-    def supertypes(self):
+    def _supertypes(self):
         l = [Type.ANY]
         for t in self.child.supertypes():
             l.append(List.get(t))
         return l
 
-    def subtypes(self):
+    def _subtypes(self):
         l = []
         for t in self.child.subtypes():
             l.append(List.get(t))
@@ -185,10 +210,10 @@ class Generic(Type):
     def specialise(self, unification):
         return unification.values.get(self.index, self)
 
-    def supertypes(self):
+    def _supertypes(self):
         return [Type.ANY, Generic.ALPHA]
 
-    def subtypes(self):
+    def _subtypes(self):
         return [Type.ANY, Generic.ALPHA]
 
 Generic.ALPHA = Generic.get(1)
@@ -215,11 +240,11 @@ class Internal(Type):
             symbol = Type._cache[name] = Internal(name)
         return symbol
 
-    def supertypes(self):
+    def _supertypes(self):
         # Don't derive "Any"
         return [self]
 
-    def subtypes(self):
+    def _subtypes(self):
         # Don't unify with generics
         # TODO is that actually the effect of this?
         return [self] #, Generic.ALPHA]
@@ -268,13 +293,13 @@ class Seq(Internal):
     def specialise(self, unification):
         return Seq.get(self.child.specialise(unification))
 
-    def supertypes(self):
+    def _supertypes(self):
         l = [] #Type.ANY]
         for t in self.child.supertypes():
             l.append(Seq.get(t))
         return l
 
-    def subtypes(self):
+    def _subtypes(self):
         l = []
         for t in self.child.subtypes():
             l.append(Seq.get(t))
@@ -312,13 +337,13 @@ class Repeat(Internal):
     def specialise(self, unification):
         return Repeat.get(self.child.specialise(unification))
 
-    def supertypes(self):
+    def _supertypes(self):
         l = [] #Type.ANY]
         for t in self.child.supertypes():
             l.append(Repeat.get(t))
         return l
 
-    def subtypes(self):
+    def _subtypes(self):
         l = []
         for t in self.child.subtypes():
             l.append(Repeat.get(t))
@@ -3,6 +3,7 @@ from .types import Type, List, Generic
 
 try:
     from rpython.rlib.rbigint import rbigint
+    from rpython.rlib.rarithmetic import ovfcheck_float_to_int
     from rpython.rlib import rope
     from rpython.rlib import jit
     from rpython.rlib.debug import make_sure_not_resized
@@ -112,31 +113,100 @@ class W_Float(Value):
 
 
 class W_Int(Value):
-    type = Type.get('Int')
-    __slots__ = ['prim']
-    _immutable_fields_ = ['prim']
+    """An integer. Either a W_SmallInt or a W_BigInt.
 
-    def __init__(self, prim):
-        assert isinstance(prim, rbigint)
-        self.prim = prim
+    Integers which fit in a machine word are always W_SmallInts; arithmetic
+    only promotes to rbigint on overflow.
+
+    """
+    type = Type.get('Int')
+    __slots__ = []
+    _immutable_fields_ = []
 
     @staticmethod
     @jit.elidable
     def fromstr(string):
-        return W_Int(rbigint.fromstr(string))
+        return W_Int.frombigint(rbigint.fromstr(string))
 
     @staticmethod
-    @jit.elidable
     def fromint(prim):
-        return W_Int(rbigint.fromint(prim))
+        if W_SmallInt.CACHE_MIN <= prim <= W_SmallInt.CACHE_MAX:
+            return W_SmallInt.CACHE[prim - W_SmallInt.CACHE_MIN]
+        return W_SmallInt(prim)
 
     @staticmethod
-    @jit.elidable
     def fromfloat(prim):
-        return W_Int(rbigint.fromfloat(prim))
+        try:
+            return W_Int.fromint(ovfcheck_float_to_int(prim))
+        except OverflowError:
+            return W_BigInt(rbigint.fromfloat(prim))
+
+    @staticmethod
+    def frombigint(prim):
+        try:
+            return W_Int.fromint(prim.toint())
+        except OverflowError:
+            return W_BigInt(prim)
+
+    def bigint(self):
+        raise NotImplementedError
+
+    def toint(self):
+        raise NotImplementedError
+
+    def tofloat(self):
+        raise NotImplementedError
+
+
+class W_SmallInt(W_Int):
+    """a machine-word integer"""
+    __slots__ = ['prim']
+    _immutable_fields_ = ['prim']
+
+    def __init__(self, prim):
+        assert isinstance(prim, int)
+        self.prim = prim
+
+    def bigint(self):
+        return rbigint.fromint(self.prim)
+
+    def toint(self):
+        return self.prim
+
+    def tofloat(self):
+        return float(self.prim)
+
+    def __repr__(self):
+        return 'W_SmallInt({!r})'.format(self.prim)
+
+    def sexpr(self):
+        return str(self.prim)
+
+W_SmallInt.CACHE_MIN = -256
+W_SmallInt.CACHE_MAX = 1024
+W_SmallInt.CACHE = [W_SmallInt(i) for i in range(W_SmallInt.CACHE_MIN, W_SmallInt.CACHE_MAX + 1)]
+
+
+class W_BigInt(W_Int):
+    """an integer which doesn't fit in a machine word"""
+    __slots__ = ['prim']
+    _immutable_fields_ = ['prim']
+
+    def __init__(self, prim):
+        assert isinstance(prim, rbigint)
+        self.prim = prim
+
+    def bigint(self):
+        return self.prim
+
+    def toint(self):
+        return self.prim.toint() # raises OverflowError
+
+    def tofloat(self):
+        return self.prim.tofloat()
 
     def __repr__(self):
-        return 'W_Int({!r})'.format(self.prim)
+        return 'W_BigInt({!r})'.format(self.prim)
 
     def sexpr(self):
         return self.prim.str()
@@ -0,0 +1,596 @@
+"""A bytecode VM for compiled trees.
+
+The Compiler flattens a tree into a Code object for a small stack machine. It
+runs after `compile(stack)`, which has already resolved every Load and Let to a
+frame slot. Each function body gets its own Code, compiled the first time it's
+called. Common node shapes get superinstructions. For example, `x < 10` is a
+single INFIX_LOCAL_CONST.
+
+Nodes the Compiler doesn't know about are evaluated in place (EVAL), so the VM
+can run any tree. The VM never rewrites the tree, so inlining doesn't happen.
+
+"""
+from rpython.rlib import jit
+from rpython.rlib.debug import make_sure_not_resized
+from rpython.rlib.objectmodel import specialize
+
+from .tree import *
+from .builtins import (UnaryBuiltin, InfixBuiltin, TernaryBuiltin,
+        BOOL_AND, BOOL_OR, IF_THEN_ELSE, IF_THEN, WHILE)
+
+
+# opcodes, and their arguments
+LOAD_CONST = 0          # const
+LOAD_LOCAL = 1          # index
+LOAD_SCOPE = 2          # depth index
+STORE_LOCAL = 3         # index
+POP = 4
+JUMP = 5                # target
+LOOP = 6                # target (a back-edge)
+JUMP_IF_FALSE = 7       # target
+JUMP_IF_TRUE = 8        # target
+CALL = 9                # argc
+TAIL_CALL = 10          # argc
+RETURN = 11
+MAKE_CLOSURE = 12       # node
+UNARY = 13              # node
+INFIX = 14              # node
+TERNARY = 15            # node
+INFIX_LOCAL_CONST = 16  # index const node
+INFIX_LOCAL_LOCAL = 17  # index index node
+LIST = 18               # count
+RECORD = 19             # node
+GET_ATTR = 20           # node
+SET_ATTR = 21           # node
+NEW_CELL = 22           # index
+LOAD_CELL = 23
+STORE_CELL = 24
+EVAL = 25               # node
+
+OPNAMES = [
+    'LOAD_CONST', 'LOAD_LOCAL', 'LOAD_SCOPE', 'STORE_LOCAL', 'POP', 'JUMP',
+    'LOOP', 'JUMP_IF_FALSE', 'JUMP_IF_TRUE', 'CALL', 'TAIL_CALL', 'RETURN',
+    'MAKE_CLOSURE', 'UNARY', 'INFIX', 'TERNARY', 'INFIX_LOCAL_CONST',
+    'INFIX_LOCAL_LOCAL', 'LIST', 'RECORD', 'GET_ATTR', 'SET_ATTR', 'NEW_CELL',
+    'LOAD_CELL', 'STORE_CELL', 'EVAL',
+]
+ARGS = [
+    1, 1, 2, 1, 0, 1,
+    1, 1, 1, 1, 1, 0,
+    1, 1, 1, 1, 3,
+    3, 1, 1, 1, 1, 1,
+    0, 0, 1,
+]
+assert len(OPNAMES) == len(ARGS) == EVAL + 1
+
+
+class Code(object):
+    _immutable_fields_ = ['name', 'ops[*]', 'consts[*]', 'nodes[*]', 'depth']
+
+    def __init__(self, name, ops, consts, nodes, depth):
+        self.name = name
+        self.ops = ops
+        self.consts = consts
+        self.nodes = nodes
+        self.depth = depth # most values ever on the stack
+
+    def new_stack(self):
+        stack = [None] * self.depth
+        make_sure_not_resized(stack)
+        return stack
+
+    def dis(self):
+        lines = []
+        pc = 0
+        while pc < len(self.ops):
+            op = self.ops[pc]
+            args = [str(self.ops[pc + 1 + i]) for i in range(ARGS[op])]
+            lines.append(" ".join([str(pc), OPNAMES[op]] + args))
+            pc += 1 + ARGS[op]
+        return "\n".join(lines)
+
+
+class Compiler(object):
+    def __init__(self):
+        self.ops = []
+        self.consts = []
+        self.nodes = []
+        self.depth = 0
+        self.max_depth = 0
+
+    def finish(self, name):
+        return Code(name, fixed(self.ops, 0), fixed(self.consts, None),
+                fixed(self.nodes, None), self.max_depth)
+
+    def emit(self, op, effect=0, a=0, b=0, c=0):
+        """Append an instruction, which pushes `effect` values. Returns its pc."""
+        pc = len(self.ops)
+        self.ops.append(op)
+        args = ARGS[op]
+        if args >= 1: self.ops.append(a)
+        if args >= 2: self.ops.append(b)
+        if args >= 3: self.ops.append(c)
+        self.depth += effect
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        return pc
+
+    def label(self):
+        return len(self.ops)
+
+    def patch(self, pc, target):
+        self.ops[pc + 1] = target
+
+    def const(self, value):
+        index = len(self.consts)
+        self.consts.append(value)
+        return index
+
+    def node(self, node):
+        index = len(self.nodes)
+        self.nodes.append(node)
+        return index
+
+    def load_const(self, value):
+        self.emit(LOAD_CONST, 1, self.const(value))
+
+    def result(self, keep, pushed):
+        """Make the stack match what the parent asked for."""
+        if pushed and not keep:
+            self.emit(POP, -1)
+        elif keep and not pushed:
+            self.load_const(None)
+
+    def compile(self, node, keep):
+        """Emit code for node. Leaves its value on the stack if `keep`."""
+        if isinstance(node, Sequence):
+            nodes = node.nodes
+            for index in range(len(nodes)):
+                self.compile(nodes[index], keep and index == len(nodes) - 1)
+            if not nodes:
+                self.result(keep, False)
+
+        elif isinstance(node, Literal):
+            if keep:
+                self.load_const(node.value)
+
+        elif isinstance(node, Load):
+            if keep:
+                self.load(node)
+
+        elif isinstance(node, Let):
+            self.compile(node.value, True)
+            self.emit(STORE_LOCAL, -1, node.index)
+            self.result(keep, False)
+
+        elif isinstance(node, Lambda):
+            if keep:
+                self.emit(MAKE_CLOSURE, 1, self.node(node))
+
+        elif isinstance(node, Return):
+            child = node.child
+            if is_call(child):
+                assert isinstance(child, Call)
+                self.call(child)
+                self.emit(TAIL_CALL, -len(child.args), len(child.args))
+            else:
+                self.compile(child, True)
+                self.emit(RETURN)
+            self.depth -= 1
+            self.result(keep, False)
+
+        elif is_call(node):
+            assert isinstance(node, Call)
+            self.call(node)
+            self.emit(CALL, -len(node.args), len(node.args))
+            self.result(keep, True)
+
+        elif isinstance(node, IF_THEN_ELSE):
+            self.compile(node.cond, True)
+            jump_false = self.emit(JUMP_IF_FALSE, -1)
+            self.compile(node.tv, keep)
+            jump_end = self.emit(JUMP)
+            if keep:
+                self.depth -= 1 # only one branch runs
+            self.patch(jump_false, self.label())
+            self.compile(node.fv, keep)
+            self.patch(jump_end, self.label())
+
+        elif isinstance(node, IF_THEN):
+            self.compile(node.cond, True)
+            jump_false = self.emit(JUMP_IF_FALSE, -1)
+            self.compile(node.body, False)
+            self.patch(jump_false, self.label())
+            self.result(keep, False)
+
+        elif isinstance(node, WHILE):
+            top = self.label()
+            self.compile(node.cond, True)
+            jump_false = self.emit(JUMP_IF_FALSE, -1)
+            self.compile(node.body, False)
+            self.emit(LOOP, 0, top)
+            self.patch(jump_false, self.label())
+            self.result(keep, False)
+
+        elif isinstance(node, BOOL_AND):
+            self.short_circuit(node, JUMP_IF_FALSE, Value.FALSE, Value.TRUE)
+            self.result(keep, True)
+
+        elif isinstance(node, BOOL_OR):
+            self.short_circuit(node, JUMP_IF_TRUE, Value.TRUE, Value.FALSE)
+            self.result(keep, True)
+
+        elif isinstance(node, UnaryBuiltin):
+            self.compile(node.child, True)
+            self.emit(UNARY, 0, self.node(node))
+            self.result(keep, True)
+
+        elif isinstance(node, InfixBuiltin):
+            self.infix(node)
+            self.result(keep, True)
+
+        elif isinstance(node, TernaryBuiltin):
+            self.compile(node.one, True)
+            self.compile(node.two, True)
+            self.compile(node.three, True)
+            self.emit(TERNARY, -2, self.node(node))
+            self.result(keep, True)
+
+        elif isinstance(node, ListLiteral):
+            count = len(node.items)
+            for item in node.items:
+                self.compile(item, True)
+            self.emit(LIST, 1 - count, count)
+            self.result(keep, True)
+
+        elif isinstance(node, RecordLiteral):
+            for value in node.values:
+                self.compile(value, True)
+            self.emit(RECORD, 1 - len(node.values), self.node(node))
+            self.result(keep, True)
+
+        elif isinstance(node, GetAttr):
+            self.compile(node.record, True)
+            self.emit(GET_ATTR, 0, self.node(node))
+            self.result(keep, True)
+
+        elif isinstance(node, SetAttr):
+            self.compile(node.record, True)
+            self.compile(node.value, True)
+            self.emit(SET_ATTR, -2, self.node(node))
+            self.result(keep, False)
+
+        elif isinstance(node, NewCell):
+            self.emit(NEW_CELL, 1, node.index)
+            self.result(keep, True)
+
+        elif isinstance(node, LoadCell):
+            self.compile(node.cell, True)
+            self.emit(LOAD_CELL)
+            self.result(keep, True)
+
+        elif isinstance(node, StoreCell):
+            self.compile(node.cell, True)
+            self.compile(node.value, True)
+            self.emit(STORE_CELL, -2)
+            self.result(keep, False)
+
+        else:
+            self.emit(EVAL, 1, self.node(node))
+            self.result(keep, True)
+
+    def load(self, node):
+        if node.depth == 0:
+            self.emit(LOAD_LOCAL, 1, node.index)
+        else:
+            self.emit(LOAD_SCOPE, 1, node.depth, node.index)
+
+    def call(self, node):
+        self.compile(node.func_node, True)
+        for arg in node.args:
+            self.compile(arg, True)
+
+    def short_circuit(self, node, jump, early, late):
+        # `early` if either side jumps, otherwise `late`.
+        self.compile(node.left, True)
+        jump_left = self.emit(jump, -1)
+        self.compile(node.right, True)
+        jump_right = self.emit(jump, -1)
+        self.load_const(late)
+        jump_end = self.emit(JUMP)
+        self.depth -= 1
+        self.patch(jump_left, self.label())
+        self.patch(jump_right, self.label())
+        self.load_const(early)
+        self.patch(jump_end, self.label())
+
+    def infix(self, node):
+        left, right = node.left, node.right
+        if is_local(left):
+            assert isinstance(left, Load)
+            if isinstance(right, Literal):
+                self.emit(INFIX_LOCAL_CONST, 1, left.index,
+                        self.const(right.value), self.node(node))
+                return
+            if is_local(right):
+                assert isinstance(right, Load)
+                self.emit(INFIX_LOCAL_LOCAL, 1, left.index, right.index,
+                        self.node(node))
+                return
+        self.compile(left, True)
+        self.compile(right, True)
+        self.emit(INFIX, -1, self.node(node))
+
+
+@specialize.call_location()
+def fixed(items, empty):
+    """A copy of items that is never resized, for a `[*]` field."""
+    result = [empty] * len(items)
+    for index in range(len(items)):
+        result[index] = items[index]
+    return result
+
+def is_call(node):
+    # Apply takes a record, not args; and InlinedStatic has its own body.
+    return (isinstance(node, Call) and not isinstance(node, Apply)
+            and not isinstance(node, InlinedStatic))
+
+def is_local(node):
+    return isinstance(node, Load) and node.depth == 0
+
+
+def compile_program(tree):
+    compiler = Compiler()
+    compiler.compile(tree, True)
+    compiler.emit(RETURN, -1)
+    return compiler.finish("program")
+
+def code_for(func):
+    """The Code for func's body, compiling it if need be."""
+    assert isinstance(func, Lambda)
+    jit.promote(func)
+    code = func.code
+    if code is None:
+        compiler = Compiler()
+        compiler.compile(func.body, True)
+        compiler.emit(RETURN, -1)
+        name = "fun " + " ".join([n.name for n in func.arg_names()])
+        code = func.code = compiler.finish(name)
+    return code
+
+
+#------------------------------------------------------------------------------
+
+def get_location(pc, code):
+    return "%s #%d %s" % (code.name, pc, OPNAMES[code.ops[pc]])
+
+vm_driver = jit.JitDriver(
+    greens = ['pc', 'code'],
+    reds = ['sp', 'stack', 'frame'],
+    is_recursive = True,
+    get_printable_location = get_location,
+)
+
+
+@jit.unroll_safe
+def new_frame(closure, stack, start, argc):
+    func = closure.func
+    jit.promote(func)
+    assert argc == func.arg_length()
+    frame = Frame(closure.scope, func.shape, func)
+    for index in range(argc):
+        frame.set(index, stack[start + index])
+    return frame
+
+@jit.unroll_safe
+def scope_at(frame, depth):
+    for i in range(depth):
+        frame = frame.parent
+    return frame
+
+@jit.unroll_safe
+def take(stack, start, count):
+    values = []
+    for index in range(count):
+        values.append(stack[start + index])
+    return values
+
+
+def run(tree, frame):
+    return execute(compile_program(tree), frame)
+
+def execute(code, frame):
+    pc = 0
+    sp = 0
+    stack = code.new_stack()
+    while True:
+        vm_driver.jit_merge_point(pc=pc, code=code, sp=sp, stack=stack, frame=frame)
+        sp = jit.promote(sp) # the same for every visit to pc
+        ops = code.ops
+        op = ops[pc]
+
+        if op == LOAD_LOCAL:
+            stack[sp] = frame.lookup(ops[pc + 1])
+            sp += 1
+            pc += 2
+
+        elif op == LOAD_CONST:
+            stack[sp] = code.consts[ops[pc + 1]]
+            sp += 1
+            pc += 2
+
+        elif op == INFIX_LOCAL_CONST:
+            node = code.nodes[ops[pc + 3]]
+            assert isinstance(node, InfixBuiltin)
+            stack[sp] = node.operate(frame.lookup(ops[pc + 1]), code.consts[ops[pc + 2]])
+            sp += 1
+            pc += 4
+
+        elif op == INFIX_LOCAL_LOCAL:
+            node = code.nodes[ops[pc + 3]]
+            assert isinstance(node, InfixBuiltin)
+            stack[sp] = node.operate(frame.lookup(ops[pc + 1]), frame.lookup(ops[pc + 2]))
+            sp += 1
+            pc += 4
+
+        elif op == INFIX:
+            node = code.nodes[ops[pc + 1]]
+            assert isinstance(node, InfixBuiltin)
+            sp -= 1
+            stack[sp - 1] = node.operate(stack[sp - 1], stack[sp])
+            pc += 2
+
+        elif op == UNARY:
+            node = code.nodes[ops[pc + 1]]
+            assert isinstance(node, UnaryBuiltin)
+            stack[sp - 1] = node.operate(stack[sp - 1])
+            pc += 2
+
+        elif op == STORE_LOCAL:
+            sp -= 1
+            frame.set(ops[pc + 1], stack[sp])
+            pc += 2
+
+        elif op == LOAD_SCOPE:
+            stack[sp] = scope_at(frame, ops[pc + 1]).lookup(ops[pc + 2])
+            sp += 1
+            pc += 3
+
+        elif op == POP:
+            sp -= 1
+            pc += 1
+
+        elif op == JUMP_IF_FALSE or op == JUMP_IF_TRUE:
+            sp -= 1
+            cond = stack[sp]
+            assert isinstance(cond, W_Bool)
+            if cond.prim == (op == JUMP_IF_TRUE):
+                pc = ops[pc + 1]
+            else:
+                pc += 2
+
+        elif op == JUMP:
+            pc = ops[pc + 1]
+
+        elif op == LOOP:
+            pc = ops[pc + 1]
+            vm_driver.can_enter_jit(pc=pc, code=code, sp=sp, stack=stack, frame=frame)
+
+        elif op == CALL:
+            argc = ops[pc + 1]
+            sp -= argc + 1
+            closure = stack[sp]
+            assert isinstance(closure, Closure)
+            inner = new_frame(closure, stack, sp + 1, argc)
+            stack[sp] = execute(code_for(closure.func), inner)
+            sp += 1
+            pc += 2
+
+        elif op == TAIL_CALL:
+            argc = ops[pc + 1]
+            sp -= argc + 1
+            closure = stack[sp]
+            assert isinstance(closure, Closure)
+            frame = new_frame(closure, stack, sp + 1, argc)
+            code = code_for(closure.func)
+            stack = code.new_stack()
+            sp = 0
+            pc = 0
+            vm_driver.can_enter_jit(pc=pc, code=code, sp=sp, stack=stack, frame=frame)
+
+        elif op == RETURN:
+            return stack[sp - 1]
+
+        elif op == MAKE_CLOSURE:
+            func = code.nodes[ops[pc + 1]]
+            assert isinstance(func, Lambda)
+            stack[sp] = Closure(frame, func)
+            sp += 1
+            pc += 2
+
+        elif op == TERNARY:
+            node = code.nodes[ops[pc + 1]]
+            assert isinstance(node, TernaryBuiltin)
+            sp -= 2
+            stack[sp - 1] = node.operate(stack[sp - 1], stack[sp], stack[sp + 1])
+            pc += 2
+
+        elif op == LIST:
+            count = ops[pc + 1]
+            sp -= count
+            items = take(stack, sp, count)
+            stack[sp] = W_List(items)
+            sp += 1
+            pc += 2
+
+        elif op == RECORD:
+            node = code.nodes[ops[pc + 1]]
+            assert isinstance(node, RecordLiteral)
+            count = len(node.keys)
+            sp -= count
+            values = take(stack, sp, count)
+            stack[sp] = W_Record(node.keys, values)
+            sp += 1
+            pc += 2
+
+        elif op == GET_ATTR:
+            node = code.nodes[ops[pc + 1]]
+            assert isinstance(node, GetAttr)
+            record = stack[sp - 1]
+            assert isinstance(record, W_Record)
+            stack[sp - 1] = node.lookup(record)
+            pc += 2
+
+        elif op == SET_ATTR:
+            node = code.nodes[ops[pc + 1]]
+            assert isinstance(node, SetAttr)
+            sp -= 2
+            record = stack[sp]
+            assert isinstance(record, W_Record)
+            node.store(record, stack[sp + 1])
+            pc += 2
+
+        elif op == NEW_CELL:
+            cell = W_Var(Value.NULL)
+            frame.set(ops[pc + 1], cell)
+            stack[sp] = cell
+            sp += 1
+            pc += 2
+
+        elif op == LOAD_CELL:
+            cell = stack[sp - 1]
+            assert isinstance(cell, W_Var)
+            stack[sp - 1] = cell.get()
+            pc += 1
+
+        elif op == STORE_CELL:
+            sp -= 2
+            cell = stack[sp]
+            assert isinstance(cell, W_Var)
+            value = stack[sp + 1]
+            if value is None: value = Value.NULL
+            cell.set(value)
+            pc += 1
+
+        elif op == EVAL:
+            node = code.nodes[ops[pc + 1]]
+            try:
+                stack[sp] = node.evaluate(frame)
+            except ReturnValue as ret:
+                return ret.value
+            except TailCall as tc:
+                # cf. Call.call_evaluate_body
+                next_call = tc.call
+                closure = next_call.func_node.evaluate(frame)
+                assert isinstance(closure, Closure)
+                frame = next_call.call_evaluate_arguments(frame, closure.scope, closure.func)
+                code = code_for(closure.func)
+                stack = code.new_stack()
+                sp = 0
+                pc = 0
+                continue
+            sp += 1
+            pc += 2
+
+        else:
+            assert False, "bad opcode"
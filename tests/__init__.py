@@ -5,16 +5,21 @@ import os
 from StringIO import StringIO
 import unittest
 import sys
+import tempfile
+import threading
 sys.path.append('./pypy/')
 
+import nefarious
 from nefarious.types import *
 from nefarious.lex import Word
 from nefarious.grammar import *
 from nefarious.tree import *
-from nefarious.grammar import parse as language_parse
-del grammar
+from nefarious.builtins import *
+from nefarious.grammar import grammar as language_grammar
+from nefarious import cache, image, parser, source, vm
+from nefarious.parser import counters
 
-from .tree import CopyTests
+from .tree import CopyTests, CacheTests
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -59,12 +64,6 @@ class TestGrammar(unittest.TestCase):
 
         DEFINE = Function('define')
 
-        @singleton
-        class Null(Macro):
-            def build(self, values, t):
-                return WordNode(None) #Word.NULL_WS
-        grammar.add(Word.WS, [], Null)
-
         LIST = Function('list')
 
         @singleton
@@ -251,6 +250,16 @@ class TypesTests(TestGrammar):
         for type_ in self.all_types:
             self.assertIn(Generic.ALPHA, type_.subtypes())
 
+    def test_lattice_cached(self):
+        Int = Type.get('Int')
+        for type_ in self.all_types + [Word.word('hello')]:
+            self.assertIs(type_.supertypes(), type_.supertypes())
+            self.assertIs(type_.subtypes(), type_.subtypes())
+        # new parametric types get their own
+        nested = List.get(List.get(List.get(Int)))
+        self.assertIs(nested.supertypes()[-1], nested)
+        self.assertEqual(nested.subtypes()[0], nested)
+
     def _accepts(self, slot, child):
         d = {}
         for key in child.supertypes():
@@ -335,8 +344,327 @@ class GrammarTests(TestGrammar):
                 continue
             self.assertIn(rule, any_rules)
 
+    def test_predict_lookahead(self):
+        Int = Type.get('Int')
+        every = list(self.grammar.predict(Int, None))
+        hello = list(self.grammar.predict(Int, Word.word('hello').lookahead()))
+        goodbye = list(self.grammar.predict(Int, Word.word('goodbye').lookahead()))
+        self.assertEqual(len(every), 2)
+        self.assertEqual(sorted(hello), sorted(every))
+        # `Int -> Int + Int` can't be ruled out without looking inside Int
+        self.assertEqual([r.symbols[0] for r in goodbye], [Int])
+
+    def test_remove(self):
+        Int = Type.get('Int')
+        rule = self.grammar.add(Int, [Word.word('bye')], Identity)
+        self.assertIn(rule, self.grammar.predict(Int, Word.word('bye').lookahead()))
+        self.grammar.remove(rule)
+        self.assertNotIn(rule, self.grammar.predict(Int, Word.word('bye').lookahead()))
+        self.assertNotIn(rule, self.grammar.get(Type.ANY))
+
+    def test_scope_rule_set(self):
+        Int = Type.get('Int')
+        before = self.grammar.get_rule_set(Int)
+        self.grammar.save()
+        self.assertIs(self.grammar.get_rule_set(Int), before)
+        rule = self.grammar.add(Int, [Word.word('bye')], Identity)
+        inner = self.grammar.get(Int)
+        self.assertEqual(inner[0], rule)
+        self.assertEqual(inner[1:], before.rules)
+        self.grammar.restore()
+        self.assertEqual(self.grammar.get(Int), before.rules)
+
+    def test_prune_shadowed(self):
+        Int = Type.get('Int')
+        bye = Word.word('bye')
+        old = self.grammar.add(Int, [bye, Word.WS, Int], Identity)
+        self.grammar.save()
+        new = self.grammar.add(Int, [bye, Word.WS, Int], Identity)
+        before = counters.pruned_items
+        predicted = list(self.grammar.predict(Int, bye.lookahead()))
+        self.assertIn(new, predicted)
+        self.assertNotIn(old, predicted)
+        self.assertEqual(counters.pruned_items, before + 1)
+        self.assertIn(old, self.grammar.get(Int))
+        self.grammar.restore()
+        self.assertIn(old, self.grammar.predict(Int, bye.lookahead()))
+
+    def test_signatures_per_layer(self):
+        """a layer shares base's Signatures, but doesn't add to them"""
+        Int = Type.get('Int')
+        bye = Word.word('bye')
+        old = self.grammar.add(Int, [bye, Word.WS, Int], Identity)
+        interned = dict(self.grammar.signatures)
+        layer = Grammar(self.grammar)
+        new = layer.add(Int, [bye, Word.WS, Int], Identity)
+        self.assertIs(new.signature, old.signature)
+        other = layer.add(Int, [bye, Word.WS, bye], Identity)
+        self.assertIsNot(other.signature, old.signature)
+        self.assertEqual(self.grammar.signatures, interned)
+        self.assertEqual(len(layer.signatures), 1)
+
+    def test_bindings(self):
+        Int = Type.get('Int')
+        x = Word.word('x')
+        outer = self.grammar.add_binding(Int, [x], Identity)
+        self.assertNotIn(outer, self.grammar.get(Int))
+        self.assertNotIn(outer, self.grammar.predict(Int, x.lookahead()))
+        self.assertEqual(list(self.grammar.bindings(x)), [outer])
+        self.grammar.save()
+        inner = self.grammar.add_binding(Int, [x], Identity)
+        self.assertGreater(inner.priority, outer.priority)
+        self.assertEqual(list(self.grammar.bindings(x)), [inner, outer])
+        self.grammar.restore()
+        self.assertEqual(list(self.grammar.bindings(x)), [outer])
+
+    def test_nullable(self):
+        A, B = Type.get('NullA'), Type.get('NullB')
+        self.grammar.add(A, [B, Word.WS, B], Identity)
+        self.assertFalse(self.grammar.is_nullable(A))
+        self.grammar.save()
+        self.grammar.add(B, [], Identity)
+        self.assertTrue(self.grammar.is_nullable(B))
+        self.assertTrue(self.grammar.is_nullable(A))
+        self.grammar.restore()
+        self.assertFalse(self.grammar.is_nullable(A))
+        self.assertFalse(self.grammar.is_nullable(B))
+
+    def test_core(self):
+        Int = Type.get('Int')
+        hello = Word.word('hello').lookahead()
+        self.grammar.freeze()
+        self.assertFalse(self.grammar.has_dynamic(Int))
+        core = []
+        for tag, rules in self.grammar.core.closure(Int, hello):
+            core += rules
+        self.assertEqual(set(core) - set(self.grammar.predict(Int, hello)), set())
+        rule = self.grammar.add(Int, [Word.word('hello'), Word.word('!')], Identity)
+        self.assertTrue(self.grammar.has_dynamic(Int))
+        self.assertEqual(list(self.grammar.predict_dynamic(Int, hello)), [rule])
+        self.assertNotIn(rule, core)
+
+    def test_specialise_shared(self):
+        Int, Text = Type.get('Int'), Type.get('Text')
+        alpha, beta = Generic.get(1), Generic.get(2)
+        rule = Rule(List.get(alpha), [alpha, Word.WS, beta], Identity)
+        a = rule.specialise(Unification({1: Int})).specialise(Unification({2: Text}))
+        b = rule.specialise(Unification({2: Text})).specialise(Unification({1: Int}))
+        self.assertIs(a, b)
+        self.assertIs(a, rule.specialise(Unification({1: Int, 2: Text})))
+        self.assertEqual(a.symbols, [Int, Word.WS, Text])
+        self.assertEqual(a.target, List.get(Int))
+        self.assertEqual(a.priority, rule.priority)
+
+    def test_unify(self):
+        Int = Type.get('Int')
+        alpha = Generic.get(1)
+        rule = Rule(List.get(alpha), [alpha, Word.WS, alpha], Identity)
+        lr0 = rule.lr0s[2]
+        specialised = lr0.unify(Int)
+        self.assertEqual(specialised.rule.symbols, [Int, Word.WS, Int])
+        self.assertEqual(specialised.dot, 2)
+        self.assertIs(lr0.unify(Int), specialised)
+        self.assertIsNone(specialised.unify(Type.get('Text')))
+
+
+class IntTests(unittest.TestCase):
+    def _int(self, value):
+        return Literal(W_Int.fromint(value), Type.get('Int'))
+
+    def _eval(self, cls, left, right):
+        return cls([left, right], cls.type).evaluate(None)
+
+    def test_small(self):
+        result = self._eval(INT_ADD, self._int(2), self._int(3))
+        self.assertIsInstance(result, W_SmallInt)
+        self.assertEqual(result.sexpr(), "5")
+        self.assertIs(W_Int.fromint(5), W_Int.fromint(5))
+
+    def test_overflow(self):
+        result = self._eval(INT_ADD, self._int(sys.maxint), self._int(1))
+        self.assertIsInstance(result, W_BigInt)
+        self.assertEqual(result.sexpr(), str(sys.maxint + 1))
+
+        result = self._eval(INT_MUL, self._int(sys.maxint), self._int(sys.maxint))
+        self.assertEqual(result.sexpr(), str(sys.maxint * sys.maxint))
+
+        result = self._eval(INT_SUB, self._int(-sys.maxint - 1), self._int(1))
+        self.assertEqual(result.sexpr(), str(-sys.maxint - 2))
+
+    def test_demote(self):
+        big = Literal(W_Int.fromstr(str(sys.maxint + 1)), Type.get('Int'))
+        self.assertIsInstance(big.value, W_BigInt)
+        result = self._eval(INT_SUB, big, self._int(1))
+        self.assertIsInstance(result, W_SmallInt)
+        self.assertEqual(result.toint(), sys.maxint)
+
+    def test_compare(self):
+        big = Literal(W_Int.fromstr(str(sys.maxint + 1)), Type.get('Int'))
+        self.assertIs(self._eval(INT_LT, self._int(1), big), Value.TRUE)
+        self.assertIs(self._eval(INT_LT, big, self._int(1)), Value.FALSE)
+        self.assertIs(self._eval(INT_EQ, self._int(7), self._int(7)), Value.TRUE)
+        self.assertIs(self._eval(INT_EQ, big, big), Value.TRUE)
+
+
+class FieldCacheTests(unittest.TestCase):
+    def _records(self, count):
+        """Records with field :x at a different index each time."""
+        padding = [Symbol.get("pad%d" % i) for i in range(count)]
+        x = Symbol.get("x")
+        return [
+            W_Record(padding[:i] + [x], [W_Int.fromint(0)] * i + [W_Int.fromint(i)])
+            for i in range(count)
+        ]
+
+    def _get(self, node, record):
+        return node.lookup(record).toint()
+
+    def test_polymorphic(self):
+        node = GetAttr(Symbol.get("x"), Load(Name("r"), Type.get('Record')))
+        records = self._records(FieldCache.LIMIT)
+        for i in range(2):
+            for index, record in enumerate(records):
+                self.assertEqual(self._get(node, record), index)
+        self.assertEqual(node.cache.shapes, [r.shape for r in records])
+        self.assertFalse(node.cache.megamorphic)
+
+    def test_megamorphic(self):
+        node = GetAttr(Symbol.get("x"), Load(Name("r"), Type.get('Record')))
+        records = self._records(FieldCache.LIMIT + 1)
+        for index, record in enumerate(records):
+            self.assertEqual(self._get(node, record), index)
+        self.assertTrue(node.cache.megamorphic)
+        self.assertEqual(node.cache.shapes, [])
+        self.assertEqual(self._get(node, records[0]), 0)
+
+    def test_store(self):
+        node = SetAttr(Symbol.get("x"), Load(Name("r"), Type.get('Record')),
+                TEST_INT_LITERAL)
+        first, second = self._records(2)
+        node.store(second, W_Int.fromint(7))
+        node.store(first, W_Int.fromint(8))
+        self.assertEqual(second.sexpr(), "[:pad0 0 :x 7]")
+        self.assertEqual(first.sexpr(), "[:x 8]")
+        self.assertEqual(node.cache.indexes, [1, 0])
+
+
+class ClosureLoadTests(unittest.TestCase):
+    def setUp(self):
+        self.names = dict((n, Name(n)) for n in "fwxyz")
+
+    def _scope(self, parent, names, values):
+        frame = Frame(parent, Shape.get([self.names[n] for n in names]))
+        for index, value in enumerate(values):
+            frame.set(index, W_Int.fromint(value))
+        return frame
+
+    def _node(self):
+        closure_node = Load(self.names["f"], Type.FUNC)
+        closure_node.depth = closure_node.index = 0
+        return ClosureLoad(self.names["x"], Type.get('Int'), closure_node)
+
+    def _load(self, node, scope):
+        frame = self._scope(None, "f", [])
+        frame.set(0, Closure(scope, None))
+        return node.evaluate(frame).toint()
+
+    def test_cached(self):
+        node = self._node()
+        outer = self._scope(None, "yx", [1, 2])
+        inner = self._scope(outer, "z", [3])
+        self.assertEqual(self._load(node, inner), 2)
+        self.assertEqual(node.shapes, [inner.shape, outer.shape])
+        self.assertEqual(node.index, 1)
+        shapes = node.shapes
+        other = self._scope(self._scope(None, "yx", [4, 5]), "z", [6])
+        self.assertEqual(self._load(node, other), 5)
+        self.assertIs(node.shapes, shapes) # a hit doesn't touch the cache
+
+    def test_shadowed(self):
+        """Same innermost shape, but the name is found elsewhere."""
+        node = self._node()
+        outer = self._scope(None, "x", [1])
+        self.assertEqual(self._load(node, self._scope(outer, "z", [2])), 1)
+        middle = self._scope(outer, "xw", [3, 4])
+        self.assertEqual(self._load(node, self._scope(middle, "z", [5])), 3)
+        self.assertEqual(node.shapes[1], middle.shape)
+
+
+class SourceTests(unittest.TestCase):
+    def _assert_closed(self, fd):
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_read_pipe(self):
+        """pipes are read in chunks, until EOF"""
+        read_fd, write_fd = os.pipe()
+        text = "x" * (source.CHUNK + 10) + "\n" # more than the pipe holds
+        def write():
+            os.write(write_fd, text)
+            os.close(write_fd)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            self.assertEqual(source.read(read_fd), text)
+        finally:
+            writer.join()
+            os.close(read_fd)
+
+    def test_load(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, "let x = 1\n")
+        os.close(write_fd)
+        loaded = source.load(read_fd)
+        self.assertIsInstance(loaded, source.Text) # always, untranslated
+        self.assertEqual(loaded.slice(0, loaded.length), "let x = 1\n")
+        self._assert_closed(read_fd)
+
+    def test_load_fails(self):
+        """the fd is closed even if it can't be read"""
+        fd = os.open(os.path.dirname(__file__), os.O_RDONLY)
+        with self.assertRaises(OSError):
+            source.load(fd)
+        self._assert_closed(fd)
+
+    def test_run_bad_image(self):
+        """run() closes the source, even if the image won't load"""
+        closed = []
+        class Spy(source.Text):
+            def close(self):
+                closed.append(self)
+        f = tempfile.NamedTemporaryFile(suffix=".nfsi")
+        f.write("not an image")
+        f.flush()
+        load_source = nefarious.load_source
+        nefarious.load_source = lambda fd: Spy("1\n")
+        try:
+            status = nefarious.run(-1, True, True, False, "", f.name, "")
+        finally:
+            nefarious.load_source = load_source
+            f.close()
+        self.assertEqual(status, 1)
+        self.assertEqual(len(closed), 1)
+
+
+class ListBuilderTests(unittest.TestCase):
+    def test_append(self):
+        a, b = [WordNode(Word.word(x)) for x in "ab"]
+        empty = ListBuilder([], 0)
+        first = empty.append(a)
+        second = first.append(b)
+        self.assertEqual(second.items(), [a, b])
+        self.assertIs(second.buffer, first.buffer) # shared
+
+    def test_branch(self):
+        """Extending an older view must not disturb the newer one."""
+        a, b, c = [WordNode(Word.word(x)) for x in "abc"]
+        first = ListBuilder([a], 1)
+        left = first.append(b)
+        right = first.append(c)
+        self.assertEqual(first.items(), [a])
+        self.assertEqual(left.items(), [a, b])
+        self.assertEqual(right.items(), [a, c])
 
-from nefarious.grammar import grammar
 
 class BaseParser(unittest.TestCase):
     # Enable stdout of columns
@@ -344,16 +672,8 @@ class BaseParser(unittest.TestCase):
 
     def setUp(self):
         super(BaseParser, self).setUp()
-        # Recover from previous failure
-        while len(grammar.stack) > 1:
-            grammar.restore()
-
         # Isolate test grammars
-        grammar.save()
-
-    def tearDown(self):
-        assert len(grammar.stack) == 2
-        grammar.restore()
+        self.session = ParseSession()
 
     def _execute(self, source):
         result = self._grammar_parse(source + "\n", debug=self.DEBUG)
@@ -412,14 +732,37 @@ class ParserTests(TestGrammar, BaseParser):
 
     def test_14(self): self._parse("range hello to hello", "(range hello hello)")
 
+    def test_14b(self):
+        """alternatives which lose aren't built"""
+        built = []
+        class Spy(Macro):
+            def build(self, values, t):
+                built.append(t)
+                return values[0]
+        self.grammar.add(Type.get('Text'), [Word.word('zap')], Select(0))
+        self.grammar.add(Type.get('Int'), [Word.word('zap')], Spy())
+        self._parse("zap", "zap")
+        self.assertEqual(built, [])
+
     def test_15(self): self._error("hello + (choose hello or goodbye)")
     def test_16(self): self._error("choose hello or goodbye")
 
+    def test_17(self):
+        """a run of different nullables can all be empty"""
+        class Empty(Macro):
+            def build(self, values, t):
+                return WordNode(Word.NULL_WS)
+        N, M = Type.get('NullN'), Type.get('NullM')
+        self.grammar.add(N, [], Empty())
+        self.grammar.add(M, [], Empty())
+        self.grammar.add(Type.get('Int'), [Word.word('zap'), N, M, N, M, Word.word('!')], Select(0))
+        self._parse("zap!", "zap")
+
 
 class LanguageTests(BaseParser):
 
     def _grammar_parse(self, source, debug):
-        return language_parse(source, debug)
+        return self.session.parse(source, debug)
 
     def test_00(self): self._success("define fib { 123 }")
     def test_01(self): self._success("define fib { 123 } \n 123")
@@ -491,3 +834,180 @@ class LanguageTests(BaseParser):
         ]
         """, "{ (record :x 1 :y 2 :z 3) }")
 
+
+    def test_12(self):
+        """right recursion"""
+        self._parse("""
+        define w Int:x { x }
+        define w { 0 }
+        w w w w
+        """, "{ (let w_Int (fun x { x })) (let w (fun { 0 })) (w_Int (w_Int (w_Int (w )))) }")
+
+    def test_13(self):
+        """earlier lines are released once they're evaluated"""
+        self._parse("""
+        let x = 1
+
+        define f Int:y { y }
+        f x
+        [
+        x x
+        ]
+        f x
+        """, "{ (let x 1) (let f_Int (fun y { y })) (f_Int x) (list x x) (f_Int x) }")
+
+    def test_15(self):
+        """evaluation doesn't recurse along long chains"""
+        self._success("[" + " ".join(["1"] * (sys.getrecursionlimit() + 100)) + "]")
+
+    def test_17(self):
+        """floats are lexed as one token"""
+        self._success("1.5e+3\n2.25") # cf. SessionTests.test_floats
+        self._error("1.5e+")
+        self._parse('"a\\"b"', '{ "a"b" }') # sexpr doesn't escape
+
+
+class SessionTests(BaseParser):
+    """Language tests which look inside the ParseSession.
+
+    Unlike LanguageTests, these aren't run against the compiled binary.
+
+    """
+    def _grammar_parse(self, source, debug):
+        return self.session.parse(source, debug)
+
+    def test_release(self):
+        """released columns drop their items, and wants nothing can complete"""
+        released = [] # (column, len(wants) before)
+        release = parser.release
+        def spy(column, window):
+            before = [(old, len(old.wants)) for old in window if old is not column]
+            release(column, window)
+            released.extend(before)
+        parser.release = spy
+        try:
+            self._success("let x = 1\n\ndefine f Int:y { y }\nf x\n[\nx x\n]\nf x")
+        finally:
+            parser.release = release
+
+        self.assertTrue(released)
+        for old, wants in released:
+            self.assertEqual(old.items, [])
+            self.assertEqual(old.unique, {})
+            self.assertLessEqual(len(old.wants), wants)
+        self.assertLess(sum(len(old.wants) for old, wants in released),
+                        sum(wants for old, wants in released))
+
+    def test_image(self):
+        """definitions can be saved to an image, and loaded back"""
+        base = self.session.highest_priority
+        fingerprint = cache.grammar_fingerprint(self.session)
+        preamble = self.session.parse("""
+        define double Int:x { INT_ADD x x }
+        let seven = 7
+        """)
+        rules = image.new_rules(self.session, base)
+        self.assertEqual(len(rules), 2)
+        data = image.dumps(fingerprint, preamble, rules)
+
+        # Start again with a new session
+        self.session = ParseSession()
+        self._error("double seven")
+
+        loaded = image.loads(data, self.session)
+        self.assertEqual(loaded.tree.sexpr(), preamble.sexpr())
+        self._parse("double seven", "{ (double_Int seven) }")
+
+    def test_isolated(self):
+        """each session has its own definitions, over the untouched base"""
+        base = language_grammar.highest_priority
+        other = ParseSession()
+        self._success("define double Int:x { INT_ADD x x }\nlet seven = 7")
+        self.assertNotIsInstance(other.parse("let seven = 3\nseven"), Error)
+        self._parse("double seven", "{ (double_Int seven) }")
+        self.assertIsInstance(other.parse("double seven"), Error)
+        self.assertEqual(language_grammar.highest_priority, base)
+        self.assertEqual(len(language_grammar.stack), 1)
+
+    def test_floats(self):
+        """floats are lexed as one token, with the right value"""
+        tree = self.session.parse("1.5e+3\n2.25\n")
+        self.assertEqual([node.value.prim for node in tree.nodes], [1500.0, 2.25])
+
+
+class VMTests(unittest.TestCase):
+    PRELUDE = """
+    defprim Int:a + Int:b { INT_ADD a b }
+    defprim Int:a - Int:b { INT_SUB a b }
+    defprim Int:a < Int:b { INT_LT a b }
+    defprim Bool:a and Bool:b { BOOL_AND a b }
+    defprim Bool:a or Bool:b { BOOL_OR a b }
+    """
+
+    def _run(self, source, use_vm):
+        with captured_output() as (out, err):
+            parse_and_run(self.PRELUDE + source, use_vm=use_vm)
+        return out.getvalue()
+
+    def _same(self, source, result):
+        output = self._run(source, True)
+        self.assertEqual(output, self._run(source, False))
+        self.assertIn("\n=> " + result + "\n", output)
+
+    def _code(self, source):
+        tree = ParseSession().parse(self.PRELUDE + source)
+        tree.compile([Shape.get([])])
+        return vm.compile_program(tree).dis()
+
+    def test_call(self):
+        self._same("""
+        define fib Int:n {
+            IF_THEN_ELSE (n < 2) 1 ((fib (n - 1)) + (fib (n - 2)))
+        }
+        fib 10
+        """, "89")
+
+    def test_while(self):
+        self._same("""
+        var i := 0
+        var total := 0
+        WHILE (i < 100) {
+            total := total + i
+            i := i + 1
+        }
+        PRINT total
+        (i < 100) or (100 < i)
+        """, "no")
+
+    def test_tail_call(self):
+        """returning a call doesn't grow the stack"""
+        self._same("""
+        define count down Int:n {
+            IF_THEN (n < 1) {
+                return 0
+            }
+            return count down (n - 1)
+            n
+        }
+        count down (%d)
+        """ % (sys.getrecursionlimit() + 100), "0")
+
+    def test_records(self):
+        self._same("""
+        let r = [:x 1 :y 2]
+        r.x := r.y + 3
+        PRINT [1 2 3]
+        let add = fun Int:a Int:b { a + b }
+        call add with [:a r.x :b 1]
+        """, "6")
+
+    def test_superinstructions(self):
+        code = self._code("""
+        let x = 1
+        x + 1
+        x + x
+        """)
+        self.assertIn("INFIX_LOCAL_CONST", code)
+        self.assertIn("INFIX_LOCAL_LOCAL", code)
+        self.assertNotIn("LOAD_LOCAL", code)
+        self.assertNotIn("EVAL", code)
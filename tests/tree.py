@@ -2,9 +2,11 @@
 # vim: tw=0
 
 import os
+import shutil
 from StringIO import StringIO
 import unittest
 import sys
+import tempfile
 sys.path.append('./pypy/')
 
 import nefarious.tree
@@ -12,6 +14,9 @@ import nefarious.builtins
 from nefarious.types import *
 from nefarious.tree import Transform
 from nefarious.builtins import *
+from nefarious.values import W_Int
+from nefarious import cache
+from nefarious.cache import CacheError, dumps, loads
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -56,6 +61,52 @@ class CopyTests(unittest.TestCase):
             self._check_copy(instance, instance.copy(NullTransform()))
 
 
+class CacheTests(unittest.TestCase):
+    """Check trees survive a round-trip through the parse cache."""
+
+    def _test_class(self, cls):
+        for instance in cls._test_cases():
+            try:
+                data = dumps(instance, "key")
+            except CacheError:
+                continue # only built by compile(), which isn't cached
+            clone = loads(data, "key")
+            self.assertEqual(clone.__class__, instance.__class__)
+            self.assertEqual(instance.sexpr(), clone.sexpr())
+
+    def test_wrong_key(self):
+        data = dumps(Literal(W_Int.fromint(1), Int), "key")
+        with self.assertRaises(CacheError):
+            loads(data, "other")
+
+    def test_truncated(self):
+        data = dumps(Literal(W_Int.fromint(1), Int), "key")
+        with self.assertRaises(CacheError):
+            loads(data[:-1], "key")
+
+    def test_big_ints(self):
+        for n in [2**62 - 1, 2**62, -2**62, -2**62 - 1, sys.maxint, -sys.maxint - 1]:
+            data = dumps(Literal(W_Int.fromint(n), Int), "key")
+            self.assertEqual(loads(data, "key").sexpr(), str(n))
+
+    def _load_corrupt(self, tree, old, new):
+        data = dumps(tree, "key")
+        assert len(old) == len(new) and data.count(old) == 1
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache.write_file(cache.path(cache_dir, "key"), data.replace(old, new))
+            return cache.load(cache_dir, "key")
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_corrupt(self):
+        """bad files are a cache miss"""
+        one = Literal(W_Int.fromint(1), Int)
+        self.assertIsNone(self._load_corrupt(LIST_LEN([one], Int), "LIST_LEN", "LIST_GET"))
+        self.assertIsNone(self._load_corrupt(Literal(W_Int.fromint(1), Type.get('Lisp')), "Lisp", "List"))
+        self.assertIsNone(self._load_corrupt(Literal(W_Int.fromint(1), Type.get('Tipe')), "Tipe", "Type"))
+
+
 # Define tests declaratively
 
 def create_test(cls):
@@ -63,6 +114,7 @@ def create_test(cls):
     def _test(self):
         self._test_class(cls)
     setattr(CopyTests, "test_{}".format(test_name), _test)
+    setattr(CacheTests, "test_{}".format(test_name), _test)
 
 def test_module_node_classes(mod):
     for name in dir(mod):